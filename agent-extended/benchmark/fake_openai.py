@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+# Deterministic OpenAI compatible API, which allows measuring the agent overhead without depending on OpenAI latency
+# and costs. Questions containing FUNCTION_CALL_KEYWORD get a contact_abstracta function call as response.
+
+FUNCTION_CALL_KEYWORD = "contact"
+
+app = FastAPI()
+config = argparse.Namespace(latency=0.5, tokens_per_second=50.0, answer_tokens=100, transcription_latency=1.0)
+
+
+def _answer_tokens() -> List[str]:
+    return [f"tok{i} " for i in range(config.answer_tokens)]
+
+
+def _chunk(delta: Dict[str, Any], finish_reason: str | None = None) -> str:
+    return "data: " + json.dumps({
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "fake",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }) + "\n\n"
+
+
+def _requires_function_call(body: Dict[str, Any]) -> bool:
+    last_message = body["messages"][-1]
+    return (("functions" in body or "tools" in body) and last_message["role"] == "user"
+            and FUNCTION_CALL_KEYWORD in (last_message.get("content") or ""))
+
+
+def _function_call_deltas(body: Dict[str, Any]) -> tuple[List[Dict[str, Any]], str]:
+    arguments = [json.dumps({"full_name": "John Doe"})]
+    if "tools" in body:
+        return ([{"role": "assistant", "content": None, "tool_calls": [
+            {"index": 0, "id": "call_0", "type": "function",
+             "function": {"name": "contact_abstracta", "arguments": ""}}]}]
+                + [{"tool_calls": [{"index": 0, "function": {"arguments": a}}]} for a in arguments], "tool_calls")
+    return ([{"role": "assistant", "content": None, "function_call": {"name": "contact_abstracta", "arguments": ""}}]
+            + [{"function_call": {"arguments": a}} for a in arguments], "function_call")
+
+
+async def _stream(body: Dict[str, Any]) -> AsyncIterator[str]:
+    await asyncio.sleep(config.latency)
+    if _requires_function_call(body):
+        deltas, finish_reason = _function_call_deltas(body)
+        for delta in deltas:
+            yield _chunk(delta)
+    else:
+        finish_reason = "stop"
+        yield _chunk({"role": "assistant", "content": ""})
+        for token in _answer_tokens():
+            await asyncio.sleep(1 / config.tokens_per_second)
+            yield _chunk({"content": token})
+    yield _chunk({}, finish_reason)
+    yield "data: [DONE]\n\n"
+
+
+@app.post('/v1/chat/completions')
+async def chat_completions(request: Request) -> Response:
+    body = await request.json()
+    if body.get("stream"):
+        return StreamingResponse(_stream(body), media_type="text/event-stream")
+    await asyncio.sleep(config.latency + config.answer_tokens / config.tokens_per_second)
+    tokens = _answer_tokens()
+    return JSONResponse({
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": "fake",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                     "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)}
+    })
+
+
+@app.post('/v1/audio/transcriptions')
+async def audio_transcriptions(request: Request) -> Response:
+    await request.body()
+    await asyncio.sleep(config.transcription_latency)
+    return JSONResponse({"text": "what time is it?"})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI API for benchmarking")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=config.latency, help="seconds before first token")
+    parser.add_argument("--tokens-per-second", type=float, default=config.tokens_per_second)
+    parser.add_argument("--answer-tokens", type=int, default=config.answer_tokens)
+    parser.add_argument("--transcription-latency", type=float, default=config.transcription_latency)
+    args = parser.parse_args()
+    config.latency = args.latency
+    config.tokens_per_second = args.tokens_per_second
+    config.answer_tokens = args.answer_tokens
+    config.transcription_latency = args.transcription_latency
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
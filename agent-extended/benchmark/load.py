@@ -0,0 +1,247 @@
+import argparse
+import asyncio
+import base64
+import contextlib
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
+
+import httpx
+
+# Load test for gpt_agent server. Unless an url is provided, it starts the agent server using the fake OpenAI API
+# defined in fake_openai.py, so it measures the server overhead and not the model latency.
+
+BENCHMARK_PATH = os.path.dirname(os.path.realpath(__file__))
+AGENT_PATH = os.path.dirname(BENCHMARK_PATH)
+
+
+@dataclass
+class Results:
+    time_to_first_token: List[float] = field(default_factory=list)
+    question_durations: List[float] = field(default_factory=list)
+    tokens_per_second: List[float] = field(default_factory=list)
+    transcription_durations: List[float] = field(default_factory=list)
+    session_durations: List[float] = field(default_factory=list)
+    errors: int = 0
+    rss_samples: List[int] = field(default_factory=list)
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+def _sse_data(events: str) -> Iterator[str]:
+    for event in events.split("\r\n\r\n"):
+        lines = event.split("\r\n")
+        if any(line.startswith("event: error") for line in lines):
+            raise ValueError("error event received")
+        if any(line.startswith("event: status") or line.startswith("event: tool") for line in lines):
+            continue
+        data = [line[len("data: "):] for line in lines if line.startswith("data: ")]
+        if data:
+            yield "\n".join(data)
+
+
+async def _ask(client: httpx.AsyncClient, url: str, session_id: str, question: str, results: Results,
+               measure_rate: bool = False) -> None:
+    start = time.perf_counter()
+    first_token = None
+    tokens = 0
+    buffer = ""
+    async with client.stream("POST", f"{url}/sessions/{session_id}/questions", json={"question": question}) as resp:
+        resp.raise_for_status()
+        async for text in resp.aiter_text():
+            buffer += text
+            complete, _, buffer = buffer.rpartition("\r\n\r\n")
+            for data in _sse_data(complete):
+                if first_token is None:
+                    first_token = time.perf_counter()
+                tokens += len(data.split())
+    end = time.perf_counter()
+    if first_token is None:
+        raise ValueError("no answer received")
+    results.time_to_first_token.append(first_token - start)
+    results.question_durations.append(end - start)
+    if measure_rate and end > first_token:
+        results.tokens_per_second.append(tokens / (end - first_token))
+
+
+async def _transcript(client: httpx.AsyncClient, url: str, session_id: str, audio: str, results: Results) -> None:
+    start = time.perf_counter()
+    resp = await client.post(f"{url}/sessions/{session_id}/transcriptions", json={"file": audio})
+    resp.raise_for_status()
+    results.transcription_durations.append(time.perf_counter() - start)
+
+
+async def _run_session(client: httpx.AsyncClient, args: argparse.Namespace, audio: str, results: Results) -> None:
+    start = time.perf_counter()
+    try:
+        resp = await client.post(f"{args.url}/sessions", json={"locales": ["en-US"]})
+        resp.raise_for_status()
+        session_id = resp.json()["id"]
+        for i in range(args.questions):
+            if args.transcriptions and i % args.transcriptions == 0:
+                await _transcript(client, args.url, session_id, audio, results)
+            if args.function_every and (i + 1) % args.function_every == 0:
+                await _ask(client, args.url, session_id, args.function_question, results)
+            else:
+                await _ask(client, args.url, session_id, args.question, results, measure_rate=True)
+        results.session_durations.append(time.perf_counter() - start)
+    except Exception as e:
+        print(f"Session error: {e!r}", file=sys.stderr)
+        results.errors += 1
+
+
+def _rss_bytes(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+async def _sample_rss(pid: int, results: Results) -> None:
+    while True:
+        rss = _rss_bytes(pid)
+        if rss is not None:
+            results.rss_samples.append(rss)
+        await asyncio.sleep(0.1)
+
+
+async def run(args: argparse.Namespace, server_pid: Optional[int]) -> Results:
+    results = Results()
+    audio = base64.b64encode(random.Random(0).randbytes(args.audio_bytes)).decode()
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        baseline_rss = _rss_bytes(server_pid) if server_pid else None
+        sampler = asyncio.create_task(_sample_rss(server_pid, results)) if server_pid else None
+        start = time.perf_counter()
+        await asyncio.gather(*[_run_session(client, args, audio, results) for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - start
+        if sampler:
+            sampler.cancel()
+    _print_report(args, results, elapsed, baseline_rss)
+    return results
+
+
+def _print_stats(name: str, values: List[float], unit: str = "ms", scale: float = 1000) -> None:
+    if not values:
+        return
+    stats = " ".join(f"{label}={value * scale:9.1f}{unit}" for label, value in [
+        ("p50", _percentile(values, 50)), ("p95", _percentile(values, 95)), ("p99", _percentile(values, 99)),
+        ("max", max(values))])
+    print(f"{name:<28} {stats} n={len(values)}")
+
+
+def _print_report(args: argparse.Namespace, results: Results, elapsed: float, baseline_rss: Optional[int]) -> None:
+    print(f"concurrency={args.concurrency} questions/session={args.questions} elapsed={elapsed:.1f}s "
+          f"errors={results.errors} questions/s={len(results.question_durations) / elapsed:.1f}")
+    _print_stats("time to first token", results.time_to_first_token)
+    _print_stats("question duration", results.question_durations)
+    _print_stats("transcription duration", results.transcription_durations)
+    _print_stats("session duration", results.session_durations)
+    _print_stats("tokens/s per stream", results.tokens_per_second, unit="", scale=1)
+    if baseline_rss and results.rss_samples:
+        peak_rss = max(results.rss_samples)
+        print(f"rss baseline={baseline_rss / 2 ** 20:.1f}MiB peak={peak_rss / 2 ** 20:.1f}MiB "
+              f"per concurrent stream={(peak_rss - baseline_rss) / args.concurrency / 2 ** 10:.1f}KiB")
+
+
+def _wait_for(url: str, process: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"process exited with code {process.returncode}")
+        with contextlib.suppress(httpx.HTTPError):
+            httpx.get(url, timeout=1)
+            return
+        time.sleep(0.2)
+    raise TimeoutError(f"{url} not available after {timeout} seconds")
+
+
+def _wait_for_status(url: str, status_code: int, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"process exited with code {process.returncode}")
+        with contextlib.suppress(httpx.HTTPError):
+            if httpx.get(url, timeout=1).status_code == status_code:
+                return
+        time.sleep(0.01)
+    raise TimeoutError(f"{url} did not respond with {status_code} after {timeout} seconds")
+
+
+@contextlib.contextmanager
+def _local_servers(args: argparse.Namespace) -> Iterator[int]:
+    fake = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_PATH, "fake_openai.py"),
+                             "--port", str(args.fake_port), "--latency", str(args.llm_latency),
+                             "--tokens-per-second", str(args.llm_tokens_per_second),
+                             "--answer-tokens", str(args.llm_answer_tokens),
+                             "--transcription-latency", str(args.transcription_latency)])
+    env = {k: v for k, v in os.environ.items() if k != "OPENID_URL"}
+    env.update({
+        "PYTHONPATH": AGENT_PATH,
+        "OPENAI_API_BASE": f"http://127.0.0.1:{args.fake_port}/v1",
+        "OPENAI_API_KEY": "fake",
+        "MODEL_NAME": "fake",
+        "TEMPERATURE": "0",
+        "SYSTEM_PROMPT": "You are a helpful AI assistant.",
+    })
+    with tempfile.TemporaryDirectory() as work_dir:
+        agent = subprocess.Popen([sys.executable, "-m", "uvicorn", "gpt_agent.api:app", "--port", str(args.port),
+                                  "--log-level", "warning"], cwd=work_dir, env=env, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL)
+        try:
+            _wait_for(f"http://127.0.0.1:{args.fake_port}/docs", fake)
+            # dependencies are loaded in background after the server accepts requests, so baseline memory is sampled
+            # once the server is ready
+            _wait_for_status(f"{args.url}/ready", 204, agent)
+            yield agent.pid
+        finally:
+            agent.terminate()
+            fake.terminate()
+            agent.wait()
+            fake.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="gpt_agent load benchmark")
+    parser.add_argument("--url", help="url of an already running agent. When not set a local agent is started using "
+                                      "a fake OpenAI API")
+    parser.add_argument("--port", type=int, default=8200, help="port for the local agent")
+    parser.add_argument("--fake-port", type=int, default=8100, help="port for the local fake OpenAI API")
+    parser.add_argument("--concurrency", type=int, default=10, help="number of concurrent sessions")
+    parser.add_argument("--questions", type=int, default=5, help="questions per session")
+    parser.add_argument("--question", default="what is the current time?")
+    parser.add_argument("--function-question", default="please contact Abstracta")
+    parser.add_argument("--function-every", type=int, default=0,
+                        help="send function question every n questions, 0 to disable")
+    parser.add_argument("--transcriptions", type=int, default=0,
+                        help="send a transcription every n questions, 0 to disable")
+    parser.add_argument("--audio-bytes", type=int, default=64 * 1024)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--llm-tokens-per-second", type=float, default=50)
+    parser.add_argument("--llm-answer-tokens", type=int, default=100)
+    parser.add_argument("--transcription-latency", type=float, default=1.0)
+    args = parser.parse_args()
+    if args.url:
+        asyncio.run(run(args, None))
+    else:
+        args.url = f"http://127.0.0.1:{args.port}"
+        with _local_servers(args) as pid:
+            asyncio.run(run(args, pid))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import contextlib
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Iterator, List, Optional
+
+import httpx
+
+from load import AGENT_PATH, BENCHMARK_PATH, _print_stats, _sse_data, _wait_for, _wait_for_status
+
+# Startup benchmark for gpt_agent server. It starts the agent server several times, using the fake OpenAI API defined
+# in fake_openai.py, and measures the time until the server accepts requests, until it reports being ready and until
+# the first answer of the first question is received.
+
+
+def _first_answer(url: str, question: str) -> tuple[float, float]:
+    start = time.perf_counter()
+    first_token: Optional[float] = None
+    with httpx.Client(timeout=60) as client:
+        session_id = client.post(f"{url}/sessions", json={"locales": ["en-US"]}).json()["id"]
+        with client.stream("POST", f"{url}/sessions/{session_id}/questions", json={"question": question}) as resp:
+            buffer = ""
+            for text in resp.iter_text():
+                buffer += text
+                complete, _, buffer = buffer.rpartition("\r\n\r\n")
+                if first_token is None and any(True for _ in _sse_data(complete)):
+                    first_token = time.perf_counter()
+    if first_token is None:
+        raise ValueError("no answer received")
+    return first_token - start, time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def _fake_openai(args: argparse.Namespace) -> Iterator[None]:
+    fake = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_PATH, "fake_openai.py"),
+                             "--port", str(args.fake_port), "--latency", str(args.llm_latency)])
+    try:
+        _wait_for(f"http://127.0.0.1:{args.fake_port}/docs", fake)
+        yield
+    finally:
+        fake.terminate()
+        fake.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="gpt_agent startup benchmark")
+    parser.add_argument("--runs", type=int, default=5, help="number of times the agent server is started")
+    parser.add_argument("--port", type=int, default=8200, help="port for the local agent")
+    parser.add_argument("--fake-port", type=int, default=8100, help="port for the local fake OpenAI API")
+    parser.add_argument("--question", default="what is the current time?")
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    args = parser.parse_args()
+    url = f"http://127.0.0.1:{args.port}"
+    env = {k: v for k, v in os.environ.items() if k != "OPENID_URL"}
+    env.update({
+        "PYTHONPATH": AGENT_PATH,
+        "OPENAI_API_BASE": f"http://127.0.0.1:{args.fake_port}/v1",
+        "OPENAI_API_KEY": "fake",
+        "MODEL_NAME": "fake",
+        "TEMPERATURE": "0",
+        "SYSTEM_PROMPT": "You are a helpful AI assistant.",
+    })
+    listening: List[float] = []
+    ready: List[float] = []
+    first_token: List[float] = []
+    first_answer: List[float] = []
+    with _fake_openai(args):
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory() as work_dir:
+                start = time.perf_counter()
+                agent = subprocess.Popen([sys.executable, "-m", "uvicorn", "gpt_agent.api:app", "--port",
+                                          str(args.port), "--log-level", "warning"], cwd=work_dir, env=env,
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                try:
+                    _wait_for_status(f"{url}/metrics", 200, agent)
+                    listening.append(time.perf_counter() - start)
+                    _wait_for_status(f"{url}/ready", 204, agent)
+                    ready.append(time.perf_counter() - start)
+                    ttft, duration = _first_answer(url, args.question)
+                    first_token.append(ttft)
+                    first_answer.append(duration)
+                finally:
+                    agent.terminate()
+                    agent.wait()
+    print(f"runs={args.runs}")
+    _print_stats("accepting requests", listening)
+    _print_stats("ready", ready)
+    _print_stats("first question first token", first_token)
+    _print_stats("first question duration", first_answer)
+
+
+if __name__ == "__main__":
+    main()
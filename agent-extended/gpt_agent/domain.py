@@ -22,4 +22,3 @@ class Question(BaseModel):
 class TranscriptionQuestion(BaseModel):
     id: uuid.UUID = Field(default_factory=uuid.uuid4)
     session: Session = Field(exclude=True)
-    base64: str
@@ -1,66 +1,192 @@
+import asyncio
 import json
+import logging
 import os
 import uuid
-import base64
 import aiofiles
 import aiofiles.os
 import datetime
+from typing import AsyncIterator, List, Optional, Tuple
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+
+from gpt_agent import repos
 from gpt_agent.domain import Session, Question, TranscriptionQuestion
 
 
+SESSIONS_PATH = "sessions"
+# question files of idle sessions may be compacted by retention sweeper into this archive, with a question per line
+QUESTIONS_ARCHIVE = "questions.jsonl.gz"
+
+
 def get_session_path(session_id: uuid.UUID) -> str:
-    return os.path.join("sessions", str(session_id))
+    return os.path.join(SESSIONS_PATH, str(session_id))
 
 
 async def _write_session_file(file_name: str, body: str, session: Session):
     file_path = os.path.join(get_session_path(session.id), file_name)
-    async with aiofiles.open(file_path, 'w') as outfile:
+    async with aiofiles.open(file_path, 'w', encoding="utf-8") as outfile:
         await outfile.write(body)
 
-async def _write_audio_file(file_name: str, body: str, session: Session):
+async def _write_audio_file(file_name: str, chunks: AsyncIterator[bytes], session: Session) -> bytes:
     session_id_path = get_session_path(session.id)
-    session_id_audio_path = os.path.join(session_id_path, "audio") 
+    session_id_audio_path = os.path.join(session_id_path, "audio")
 
     if os.path.exists(session_id_path):
         os.makedirs(session_id_audio_path, exist_ok=True)
 
     audio_file_path = os.path.join(session_id_audio_path, file_name)
 
-    async with aiofiles.open(audio_file_path, 'wb') as outfile:
-        await outfile.write(base64.b64decode(body))
-    return audio_file_path
+    ret = bytearray()
+    try:
+        async with aiofiles.open(audio_file_path, 'wb') as outfile:
+            async for chunk in chunks:
+                ret.extend(chunk)
+                await outfile.write(chunk)
+    except BaseException:
+        await aiofiles.os.remove(audio_file_path)
+        raise
+    return bytes(ret)
 
 
 
-class SessionsRepository:
+class SessionsRepository(repos.SessionsRepository):
 
-    @staticmethod
-    async def save_session(session: Session) -> None:
+    async def _write_session(self, session: Session) -> None:
         session_path = get_session_path(session.id)
         await aiofiles.os.makedirs(session_path, exist_ok=True)
         await _write_session_file('session.json', session.model_dump_json(), session)
 
-    @staticmethod
-    async def find_session(session_id: str) -> Session | None:
-        session_path = get_session_path(uuid.UUID(session_id))
+    async def _read_session(self, session_id: uuid.UUID) -> Session | None:
+        session_path = get_session_path(session_id)
         if not await aiofiles.os.path.exists(session_path):
             return None
-        async with aiofiles.open(os.path.join(session_path, 'session.json')) as f:
+        async with aiofiles.open(os.path.join(session_path, 'session.json'), encoding="utf-8") as f:
             session_dict = json.loads(await f.read())
             return Session(**session_dict)
 
 
-class QuestionsRepository:
+class QuestionsRepository(repos.QuestionsRepository):
 
-    @staticmethod
-    async def save_question(question: Question) -> None:
-        await _write_session_file(f'question-{question.id}.json', question.model_dump_json(), question.session)
+    async def save_questions(self, questions: List[Question]) -> None:
+        await asyncio.gather(*[_write_session_file(f'question-{question.id}.json', question.model_dump_json(),
+                                                   question.session) for question in questions])
 
-class TranscriptionsRepository:
+class TranscriptionsRepository(repos.TranscriptionsRepository):
 
-    @staticmethod
-    async def save_audio(question: TranscriptionQuestion) -> str:
+    async def save_audio(self, question: TranscriptionQuestion, chunks: AsyncIterator[bytes]) -> bytes:
         now = datetime.datetime.now()
         formatted_date = now.strftime("%Y-%m-%d_%H-%M-%S")
-        file_path = await _write_audio_file(f'{formatted_date}.webm', question.base64, question.session)
-        return file_path
+        return await _write_audio_file(f'{formatted_date}.webm', chunks, question.session)
+
+
+class JsonLinesChatMessageHistory(BaseChatMessageHistory):
+    # Stores each message as a line appended to chat_history.jsonl, instead of rewriting the whole history on each new
+    # message like FileChatMessageHistory does. Messages are kept in memory, so reads don't touch the file, and writes
+    # are done in background when there is a running event loop. Messages appended by other processes can be loaded with
+    # refresh, which only reads the file from the last known position.
+
+    def __init__(self, session_path: str):
+        self._file_path = os.path.join(session_path, "chat_history.jsonl")
+        self._messages: List[BaseMessage] = []
+        self._pending: List[str] = []
+        self._truncate = False
+        self._flush_task: Optional[asyncio.Task] = None
+        self._offset = 0
+        # session folder may not exist when sessions are stored in a different storage backend
+        os.makedirs(session_path, exist_ok=True)
+        self._legacy_file_path = os.path.join(session_path, "chat_history.json")
+        # legacy history is migrated by refresh, which is called while holding the session lock, so only one process
+        # migrates it
+        if os.path.exists(self._file_path):
+            self.refresh()
+
+    @staticmethod
+    def _to_line(message: BaseMessage) -> str:
+        return json.dumps(message_to_dict(message)) + "\n"
+
+    def refresh(self) -> None:
+        if not os.path.exists(self._file_path):
+            self._migrate_legacy()
+            if not os.path.exists(self._file_path):
+                return
+        size = os.path.getsize(self._file_path)
+        if size == self._offset:
+            return
+        if size < self._offset:
+            # history was cleared by another process
+            self._messages, self._offset = [], 0
+        with open(self._file_path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        # a line may be partially written, so only complete lines are loaded
+        complete = data[:data.rfind(b"\n") + 1]
+        self._messages.extend(messages_from_dict([json.loads(line) for line in complete.decode().splitlines()
+                                                  if line.strip()]))
+        self._offset += len(complete)
+
+    def _migrate_legacy(self) -> None:
+        if not os.path.exists(self._legacy_file_path):
+            return
+        with open(self._legacy_file_path, encoding="utf-8") as f:
+            messages = messages_from_dict(json.load(f))
+        # written to a temporary file, so processes not holding the session lock never read a partial history
+        tmp_file_path = self._file_path + ".tmp"
+        with open(tmp_file_path, 'wb') as f:
+            f.write("".join(self._to_line(m) for m in messages).encode())
+        os.replace(tmp_file_path, self._file_path)
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return self._messages
+
+    def add_message(self, message: BaseMessage) -> None:
+        self._messages.append(message)
+        self._pending.append(self._to_line(message))
+        self._schedule_flush()
+
+    def clear(self) -> None:
+        self._messages = []
+        self._pending = []
+        self._truncate = True
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._flush_sync()
+            return
+        self._flush_task = loop.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        while self._pending or self._truncate:
+            lines, mode = self._take_pending()
+            try:
+                async with aiofiles.open(self._file_path, mode + 'b') as f:
+                    await f.write("".join(lines).encode())
+                    self._offset = await f.tell()
+            except Exception as e:
+                logging.exception("Error writing chat history to %s", self._file_path, exc_info=e)
+                self._pending = lines + self._pending
+                self._truncate = self._truncate or mode == 'w'
+                return
+
+    def _take_pending(self) -> Tuple[List[str], str]:
+        lines, self._pending = self._pending, []
+        mode = 'w' if self._truncate else 'a'
+        self._truncate = False
+        return lines, mode
+
+    def _flush_sync(self) -> None:
+        lines, mode = self._take_pending()
+        with open(self._file_path, mode + 'b') as f:
+            f.write("".join(lines).encode())
+            self._offset = f.tell()
+
+    async def aflush(self) -> None:
+        if self._flush_task:
+            await self._flush_task
@@ -0,0 +1,100 @@
+import contextvars
+import enum
+import json
+import os
+import string
+from typing import Dict, List, Optional
+
+from langchain_core import pydantic_v1
+from langchain_core.tools import StructuredTool
+from pydantic import BaseModel
+
+
+class AgentAction(enum.Enum):
+    MESSAGE = "message"
+    CLICK = "click"
+    FILL = "fill"
+    GOTO = "goto"
+
+
+class AgentStep(BaseModel):
+    action: AgentAction
+    selector: Optional[str] = None
+    value: Optional[str] = None
+
+
+class AgentFlow(BaseModel):
+    steps: List[AgentStep]
+
+    @staticmethod
+    def message(text: str) -> 'AgentFlow':
+        return AgentFlow(steps=[AgentStep(action=AgentAction.MESSAGE, value=text)])
+
+
+class FlowChannel:
+    # passes flows generated by tools to the answer stream, so they don't need to be serialized as tool results and
+    # parsed again to identify them
+
+    def __init__(self):
+        self.flows: List[AgentFlow] = []
+        self.last_output: Optional[str] = None
+
+
+_flow_channel: contextvars.ContextVar[Optional[FlowChannel]] = contextvars.ContextVar("flow_channel", default=None)
+
+
+def set_flow_channel(channel: FlowChannel) -> None:
+    # tools run in the task setting the channel, or in tasks created by it, get the channel from the context
+    _flow_channel.set(channel)
+
+
+def emit_flow(flow: AgentFlow) -> str:
+    # returns the text to use as tool result, which is what the LLM and chat history get instead of the flow steps
+    ret = " ".join(step.value for step in flow.steps if step.action == AgentAction.MESSAGE and step.value) \
+        or "Flow sent to the browser"
+    channel = _flow_channel.get()
+    if channel:
+        channel.flows.append(flow)
+        channel.last_output = ret
+    return ret
+
+
+class _StepTemplate:
+
+    def __init__(self, step: AgentStep):
+        self._action = step.action
+        self._selector = string.Template(step.selector) if step.selector is not None else None
+        self._value = string.Template(step.value) if step.value is not None else None
+
+    def render(self, params: Dict[str, str]) -> AgentStep:
+        # steps were already validated when loading the template, so there is no need to validate them again
+        return AgentStep.model_construct(action=self._action,
+                                         selector=self._selector.substitute(params) if self._selector else None,
+                                         value=self._value.substitute(params) if self._value else None)
+
+
+class FlowTemplate(BaseModel):
+    description: str
+    parameters: Dict[str, str] = {}
+    steps: List[AgentStep]
+
+    def build_tool(self, name: str) -> StructuredTool:
+        steps = [_StepTemplate(step) for step in self.steps]
+        args_schema = pydantic_v1.create_model(name, **{param: (str, pydantic_v1.Field(description=description))
+                                                        for param, description in self.parameters.items()})
+
+        async def run(**kwargs: str) -> str:
+            return emit_flow(AgentFlow.model_construct(steps=[step.render(kwargs) for step in steps]))
+
+        return StructuredTool(name=name, description=self.description, args_schema=args_schema, coroutine=run,
+                              return_direct=True)
+
+
+def load_flow_tools(path: str) -> List[StructuredTool]:
+    # flows defined in the file are exposed as tools which fill the parameters of the flow with the ones provided by
+    # the LLM. Parameters are referenced in flow steps selector and value as ${parameter} (and $ is escaped as $$)
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        templates = json.load(f)
+    return [FlowTemplate.model_validate(template).build_tool(name) for name, template in templates.items()]
@@ -0,0 +1,68 @@
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+from gpt_agent import metrics
+
+TIMEOUT = httpx.Timeout(float(os.getenv("HTTP_READ_TIMEOUT_SECONDS", "120")),
+                        connect=float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "5")))
+
+
+def _build_transport() -> httpx.AsyncHTTPTransport:
+    return httpx.AsyncHTTPTransport(
+        # connections to servers supporting HTTP/2 (like Azure and OpenAI APIs) multiplex concurrent requests instead
+        # of opening one connection per in flight request
+        http2=os.getenv("HTTP2", "true") == "true",
+        limits=httpx.Limits(max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+                            max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20")),
+                            keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY_SECONDS", "60"))))
+
+
+# the connection pool lives in the transport, so sharing it allows LLM, transcription and OpenID requests to reuse
+# connections (avoiding DNS resolution, TCP and TLS handshakes) while each client keeps its own event hooks
+_transport = _build_transport()
+
+
+class _NonClosingTransport(httpx.AsyncBaseTransport):
+    # clients may be closed by their owners (eg: OpenAI clients used as context managers), which should not close
+    # connections used by other clients
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self._transport.handle_async_request(request)
+
+
+async def _track_request(request: httpx.Request) -> None:
+    upstream = request.url.netloc.decode()
+    start = time.perf_counter()
+    connect_start: Optional[float] = None
+    # TLS handshake completes the connection setup for https, plain TCP connection for http
+    connected_event = "connection.start_tls.complete" if request.url.scheme == "https" \
+        else "connection.connect_tcp.complete"
+
+    async def trace(event_name: str, _: Dict[str, Any]) -> None:
+        nonlocal connect_start
+        if event_name == "connection.connect_tcp.started":
+            connect_start = time.perf_counter()
+            metrics.http_connections.inc(1, upstream)
+        elif event_name == connected_event and connect_start is not None:
+            metrics.http_connect_seconds.observe(time.perf_counter() - connect_start, upstream)
+        elif event_name.endswith(".receive_response_headers.complete"):
+            metrics.http_response_seconds.observe(time.perf_counter() - start, upstream)
+
+    metrics.http_requests.inc(1, upstream)
+    request.extensions["trace"] = trace
+
+
+def build_client(response_hooks: Optional[List[Callable[[httpx.Response], Awaitable[None]]]] = None) \
+        -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=_NonClosingTransport(_transport), timeout=TIMEOUT,
+                             event_hooks={"request": [_track_request], "response": response_hooks or []})
+
+
+async def close() -> None:
+    await _transport.aclose()
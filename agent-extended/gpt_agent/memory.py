@@ -0,0 +1,94 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+import aiofiles
+from langchain.chains import LLMChain
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain_core.messages import BaseMessage, get_buffer_string
+
+from gpt_agent.scheduler import llm_scheduler
+
+
+def estimate_tokens(text: str) -> int:
+    # rough approximation (~4 chars per token for english text) which avoids requiring a tokenizer
+    return len(text) // 4 + 1
+
+
+class BackgroundSummaryBufferMemory(ConversationSummaryBufferMemory):
+    # Keeps the latest messages, up to max_token_limit tokens, verbatim and folds older ones into a running summary.
+    # Unlike ConversationSummaryBufferMemory, summarization runs in background after each response is saved, instead of
+    # blocking the request, and the summary is persisted next to the chat history so reloaded sessions can reuse it.
+    # Summarization calls are admitted by llm_scheduler on behalf of user, like questions.
+
+    summary_file_path: str
+    user: str = ""
+    summarized_messages: int = 0
+    summary_task: Optional[Any] = None
+
+    @classmethod
+    def load(cls, session_path: str, **kwargs: Any) -> 'BackgroundSummaryBufferMemory':
+        summary_file_path = os.path.join(session_path, "chat_summary.json")
+        summary = {}
+        if os.path.exists(summary_file_path):
+            with open(summary_file_path, encoding="utf-8") as f:
+                summary = json.load(f)
+        return cls(summary_file_path=summary_file_path, moving_summary_buffer=summary.get("summary", ""),
+                   summarized_messages=summary.get("messages", 0), **kwargs)
+
+    @property
+    def buffer(self) -> List[BaseMessage]:
+        return self.chat_memory.messages[self.summarized_messages:]
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        BaseChatMemory.save_context(self, inputs, outputs)
+        if self.summary_task and not self.summary_task.done():
+            return
+        try:
+            self.summary_task = asyncio.get_running_loop().create_task(self._summarize())
+        except RuntimeError:
+            # no event loop, so we just skip summarization until next saved context
+            pass
+
+    async def _summarize(self) -> None:
+        try:
+            while await self.aprune():
+                pass
+        except Exception as e:
+            logging.exception("Error summarizing chat history", exc_info=e)
+
+    async def aprune(self) -> bool:
+        buffer = self.buffer
+        tokens = [estimate_tokens(get_buffer_string([m])) for m in buffer]
+        total_tokens = sum(tokens)
+        pruned = 0
+        # always keep at least the last message verbatim
+        while total_tokens > self.max_token_limit and pruned < len(buffer) - 1:
+            total_tokens -= tokens[pruned]
+            pruned += 1
+        if not pruned:
+            return False
+        self.moving_summary_buffer = await self.apredict_new_summary(buffer[:pruned], self.moving_summary_buffer)
+        self.summarized_messages += pruned
+        await self._save_summary()
+        return True
+
+    async def apredict_new_summary(self, messages: List[BaseMessage], existing_summary: str) -> str:
+        new_lines = get_buffer_string(messages, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix)
+        chain = LLMChain(llm=self.llm, prompt=self.prompt)
+        async with llm_scheduler.admission(self.user, estimate_tokens(existing_summary + new_lines)) as admission:
+            await admission.wait()
+            return await chain.apredict(summary=existing_summary, new_lines=new_lines)
+
+    async def _save_summary(self) -> None:
+        async with aiofiles.open(self.summary_file_path, 'w', encoding="utf-8") as f:
+            await f.write(json.dumps({"summary": self.moving_summary_buffer, "messages": self.summarized_messages}))
+
+    def clear(self) -> None:
+        super().clear()
+        self.summarized_messages = 0
+        if os.path.exists(self.summary_file_path):
+            os.remove(self.summary_file_path)
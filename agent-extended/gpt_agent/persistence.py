@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import os
+from typing import List, Optional
+
+from gpt_agent import metrics
+from gpt_agent.domain import Question
+from gpt_agent.repos import QuestionsRepository
+
+
+class QuestionsWriter:
+    # persists questions in background batches, so answer streams don't have to wait for questions to be stored.
+    # When the queue is full, saving waits for queued questions to be persisted.
+
+    def __init__(self, repo: QuestionsRepository, max_queue_size: int, batch_size: int, batch_wait_seconds: float):
+        self._repo = repo
+        self._queue: asyncio.Queue[Question] = asyncio.Queue(maxsize=max_queue_size)
+        self._batch_size = batch_size
+        self._batch_wait_seconds = batch_wait_seconds
+        self._worker: Optional[asyncio.Task] = None
+
+    async def save(self, question: Question) -> None:
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+        await self._queue.put(question)
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            try:
+                with metrics.persistence_seconds.time():
+                    await self._repo.save_questions(batch)
+            except Exception as e:
+                logging.exception("Error saving %d questions", len(batch), exc_info=e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _next_batch(self) -> List[Question]:
+        ret = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self._batch_wait_seconds
+        while len(ret) < self._batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                ret.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return ret
+
+    async def stop(self) -> None:
+        if self._worker is None:
+            return
+        await self._queue.join()
+        self._worker.cancel()
+        self._worker = None
+
+
+def build_questions_writer(repo: QuestionsRepository) -> QuestionsWriter:
+    return QuestionsWriter(repo, max_queue_size=int(os.getenv("QUESTIONS_QUEUE_SIZE", "1000")),
+                           batch_size=int(os.getenv("QUESTIONS_BATCH_SIZE", "50")),
+                           batch_wait_seconds=float(os.getenv("QUESTIONS_BATCH_WAIT_SECONDS", "0.1")))
@@ -0,0 +1,92 @@
+import datetime
+import os
+import uuid
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, List, Optional, Tuple
+
+from gpt_agent.cache import LruCache
+from gpt_agent.domain import Session, Question, TranscriptionQuestion
+
+_MISSING = object()
+
+
+class SessionsRepository(ABC):
+
+    def __init__(self):
+        # sessions are cached to avoid reading them from storage on each question, and unknown ids are cached for a
+        # shorter time to avoid hitting the storage on invalid session probes
+        self._cache: LruCache[Optional[Session]] = LruCache(
+            max_size=int(os.getenv("SESSIONS_CACHE_SIZE", "10000")),
+            ttl_seconds=float(os.getenv("SESSIONS_CACHE_TTL_SECONDS", "3600")))
+        self._missing_ttl_seconds = float(os.getenv("SESSIONS_MISSING_CACHE_TTL_SECONDS", "30"))
+
+    async def save_session(self, session: Session) -> None:
+        await self._write_session(session)
+        self._cache.put(session.id, session)
+
+    @abstractmethod
+    async def _write_session(self, session: Session) -> None:
+        pass
+
+    async def find_session(self, session_id: str) -> Session | None:
+        key = uuid.UUID(session_id)
+        ret = self._cache.get(key, _MISSING)
+        if ret is not _MISSING:
+            return ret
+        ret = await self._read_session(key)
+        self._cache.put(key, ret, None if ret else self._missing_ttl_seconds)
+        return ret
+
+    @abstractmethod
+    async def _read_session(self, session_id: uuid.UUID) -> Session | None:
+        pass
+
+    async def delete_session(self, session_id: uuid.UUID) -> None:
+        # called by retention sweeper after deleting the session folder
+        await self._delete_session(session_id)
+        self._cache.pop(session_id)
+
+    async def _delete_session(self, session_id: uuid.UUID) -> None:
+        # sessions stored in sessions folder are deleted with it
+        pass
+
+
+class QuestionsRepository(ABC):
+
+    async def save_question(self, question: Question) -> None:
+        await self.save_questions([question])
+
+    @abstractmethod
+    async def save_questions(self, questions: List[Question]) -> None:
+        pass
+
+    async def delete_questions(self, before: datetime.datetime) -> int:
+        # questions stored in sessions folder are deleted by retention sweeper
+        return 0
+
+
+class TranscriptionsRepository(ABC):
+
+    @abstractmethod
+    async def save_audio(self, question: TranscriptionQuestion, chunks: AsyncIterator[bytes]) -> bytes:
+        # stores the audio chunks as they are received and returns the complete audio
+        pass
+
+    async def delete_audios(self, before: datetime.datetime) -> int:
+        # audios stored in sessions folder are deleted by retention sweeper
+        return 0
+
+
+def build_repos() -> Tuple[SessionsRepository, QuestionsRepository, TranscriptionsRepository]:
+    backend = os.getenv("STORAGE_BACKEND", "file")
+    # backends are imported on demand since they depend on this module
+    if backend == "file":
+        from gpt_agent import file_system_repos
+        return (file_system_repos.SessionsRepository(), file_system_repos.QuestionsRepository(),
+                file_system_repos.TranscriptionsRepository())
+    elif backend == "sqlite":
+        from gpt_agent import sqlite_repos
+        db = sqlite_repos.SqliteDatabase(os.getenv("SQLITE_DB_PATH", "sessions.db"))
+        return (sqlite_repos.SessionsRepository(db), sqlite_repos.QuestionsRepository(db),
+                sqlite_repos.TranscriptionsRepository(db))
+    raise ValueError(f"Unsupported storage backend: {backend}")
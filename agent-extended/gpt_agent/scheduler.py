@@ -0,0 +1,154 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Deque, Dict, Optional
+
+import httpx
+from pydantic import BaseModel
+
+from gpt_agent import metrics
+
+
+class QueueStatus(BaseModel):
+    position: int
+
+
+class Admission:
+
+    def __init__(self, user: str, tokens: int):
+        self.user = user
+        self.tokens = tokens
+        self.position = 0
+        self._granted = asyncio.Event()
+
+    @property
+    def granted(self) -> bool:
+        return self._granted.is_set()
+
+    def grant(self) -> None:
+        self._granted.set()
+
+    async def wait(self, timeout: Optional[float] = None) -> None:
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._granted.wait(), timeout)
+
+
+class LlmScheduler:
+    # Limits LLM calls in progress, globally and per user, and the rate of estimated prompt tokens sent to the LLM
+    # (with a token bucket), to avoid exceeding OpenAI quotas. Waiting calls are admitted in round-robin order across
+    # users, so a user with many questions doesn't delay others. When OpenAI responds with 429 no new calls are admitted
+    # until the retry-after time, while the OpenAI client retries the call with a jittered backoff.
+
+    def __init__(self, max_concurrency: int, max_per_user: int, tokens_per_minute: int):
+        self._max_concurrency = max_concurrency
+        self._max_per_user = max_per_user
+        self._bucket_capacity = tokens_per_minute
+        self._bucket_tokens = float(tokens_per_minute)
+        self._bucket_updated = time.monotonic()
+        self._paused_until = 0.0
+        self._queues: OrderedDict[str, Deque[Admission]] = OrderedDict()
+        self._in_flight = 0
+        self._user_in_flight: Dict[str, int] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @contextlib.asynccontextmanager
+    async def admission(self, user: str, tokens: int) -> AsyncIterator[Admission]:
+        ret = Admission(user, min(tokens, self._bucket_capacity) if self._bucket_capacity > 0 else 0)
+        self._queues.setdefault(user, deque()).append(ret)
+        self._dispatch()
+        try:
+            yield ret
+        finally:
+            if ret.granted:
+                self._in_flight -= 1
+                self._user_in_flight[user] -= 1
+                if not self._user_in_flight[user]:
+                    del self._user_in_flight[user]
+            else:
+                self._remove(ret)
+            self._dispatch()
+
+    def _remove(self, admission: Admission) -> None:
+        queue = self._queues[admission.user]
+        queue.remove(admission)
+        if not queue:
+            del self._queues[admission.user]
+
+    def _dispatch(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        if now < self._paused_until:
+            self._schedule_dispatch(self._paused_until - now)
+        else:
+            self._refill_bucket(now)
+            self._admit()
+        self._update_positions()
+
+    def _refill_bucket(self, now: float) -> None:
+        if self._bucket_capacity > 0:
+            self._bucket_tokens = min(self._bucket_capacity, self._bucket_tokens + (now - self._bucket_updated)
+                                      * self._bucket_capacity / 60)
+        self._bucket_updated = now
+
+    def _admit(self) -> None:
+        admitted = True
+        while admitted and self._queues:
+            admitted = False
+            for user in list(self._queues):
+                if self._in_flight >= self._max_concurrency:
+                    return
+                if self._user_in_flight.get(user, 0) >= self._max_per_user:
+                    continue
+                queue = self._queues[user]
+                admission = queue[0]
+                if admission.tokens > self._bucket_tokens:
+                    # wait for bucket refill instead of admitting smaller calls, to avoid starving big prompts
+                    self._schedule_dispatch((admission.tokens - self._bucket_tokens) * 60 / self._bucket_capacity)
+                    return
+                queue.popleft()
+                # move the user to the end of the queues, so the next admitted call is from another user
+                del self._queues[user]
+                if queue:
+                    self._queues[user] = queue
+                self._bucket_tokens -= admission.tokens
+                self._in_flight += 1
+                self._user_in_flight[user] = self._user_in_flight.get(user, 0) + 1
+                admission.grant()
+                admitted = True
+
+    def _schedule_dispatch(self, delay: float) -> None:
+        self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def _update_positions(self) -> None:
+        # estimates position in round-robin order: calls in front in the user queue, plus calls from users before in
+        # the round which are at the same or earlier positions in their queues, plus calls from users after in the round
+        # which are at earlier positions in their queues
+        queue_sizes = [len(queue) for queue in self._queues.values()]
+        for user_index, queue in enumerate(self._queues.values()):
+            for index, admission in enumerate(queue):
+                admission.position = (sum(min(size, index + 1) for size in queue_sizes[:user_index]) + index + 1
+                                      + sum(min(size, index) for size in queue_sizes[user_index + 1:]))
+        metrics.queued_llm_calls.set(sum(queue_sizes))
+
+    async def track_response(self, response: httpx.Response) -> None:
+        if response.status_code != 429:
+            return
+        try:
+            retry_after = float(response.headers.get("retry-after", "1"))
+        except ValueError:
+            retry_after = 1
+        logging.warning("LLM quota exceeded, pausing LLM calls for %s seconds", retry_after)
+        metrics.llm_rate_limited.inc()
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        self._bucket_tokens = 0
+        self._dispatch()
+
+
+llm_scheduler = LlmScheduler(max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "50")),
+                             max_per_user=int(os.getenv("LLM_MAX_CONCURRENCY_PER_USER", "2")),
+                             tokens_per_minute=int(os.getenv("LLM_TOKENS_PER_MINUTE", "0")))
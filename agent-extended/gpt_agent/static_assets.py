@@ -0,0 +1,61 @@
+import gzip
+import hashlib
+import mimetypes
+from typing import Dict, List, Optional
+
+import brotli
+from starlette.requests import Request
+from starlette.responses import Response
+
+
+def _accepted_encodings(accept_encoding: str) -> List[str]:
+    ret = []
+    for part in accept_encoding.split(","):
+        encoding, *params = [p.strip() for p in part.split(";")]
+        quality = next((p[2:] for p in params if p.startswith("q=")), "1")
+        try:
+            if float(quality) > 0:
+                ret.append(encoding.lower())
+        except ValueError:
+            pass
+    return ret
+
+
+class StaticAsset:
+    # Keeps an asset in memory with precomputed compressed variants and strong ETags, so requests don't read, render
+    # or compress it again, and clients (like browsers with the extension) can revalidate cached copies getting a 304
+    # response without content.
+
+    def __init__(self, content: bytes, media_type: str, max_age_seconds: int = 300):
+        self._media_type = media_type
+        self._cache_control = f"public, max-age={max_age_seconds}"
+        digest = hashlib.sha256(content).hexdigest()[:32]
+        self._variants: Dict[Optional[str], bytes] = {None: content}
+        self._etags: Dict[Optional[str], str] = {None: f'"{digest}"'}
+        compressors = {"gzip": lambda c: gzip.compress(c, mtime=0), "br": brotli.compress}
+        for encoding, compress in compressors.items():
+            compressed = compress(content)
+            # already compressed formats (like png) are not worth serving compressed
+            if len(compressed) < len(content):
+                self._variants[encoding] = compressed
+                # each variant needs its own strong ETag since they have different bytes
+                self._etags[encoding] = f'"{digest}-{encoding}"'
+
+    @staticmethod
+    def from_file(path: str, media_type: Optional[str] = None, max_age_seconds: int = 300) -> 'StaticAsset':
+        with open(path, 'rb') as f:
+            content = f.read()
+        return StaticAsset(content, media_type or mimetypes.guess_type(path)[0] or "application/octet-stream",
+                           max_age_seconds)
+
+    def response(self, request: Request) -> Response:
+        accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+        encoding = next((e for e in ("br", "gzip") if e in self._variants and e in accepted), None)
+        headers = {"ETag": self._etags[encoding], "Cache-Control": self._cache_control, "Vary": "Accept-Encoding"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and (if_none_match.strip() == "*" or any(
+                tag.strip().removeprefix("W/") in self._etags.values() for tag in if_none_match.split(","))):
+            return Response(status_code=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return Response(self._variants[encoding], media_type=self._media_type, headers=headers)
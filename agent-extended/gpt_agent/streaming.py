@@ -0,0 +1,73 @@
+import asyncio
+import enum
+from typing import AsyncIterator, List, TypeVar
+
+from pydantic import BaseModel
+
+T = TypeVar('T')
+
+
+class ToolStatus(enum.Enum):
+    STARTED = "started"
+    FINISHED = "finished"
+    FAILED = "failed"
+
+
+class ToolEvent(BaseModel):
+    tool: str
+    status: ToolStatus
+
+
+async def coalesce_tokens(tokens: AsyncIterator[str | T], window_seconds: float, max_chars: int) \
+        -> AsyncIterator[str | T]:
+    # Joins string tokens received within a time window (or until max_chars is reached) to reduce the number of
+    # generated events. The first token is always sent immediately so perceived latency is not affected, and
+    # non string elements are passed through after flushing any pending tokens.
+    loop = asyncio.get_running_loop()
+    it = tokens.__aiter__()
+    buffer: List[str] = []
+    size = 0
+    deadline = None
+    first = True
+    next_token = asyncio.ensure_future(it.__anext__())
+    try:
+        while True:
+            timeout = None if deadline is None else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({next_token}, timeout=timeout)
+            if not done:
+                yield "".join(buffer)
+                buffer, size, deadline = [], 0, None
+                continue
+            try:
+                token = next_token.result()
+            except StopAsyncIteration:
+                break
+            next_token = asyncio.ensure_future(it.__anext__())
+            if token == "":
+                continue
+            if not isinstance(token, str):
+                if buffer:
+                    yield "".join(buffer)
+                    buffer, size, deadline = [], 0, None
+                yield token
+            elif first:
+                first = False
+                yield token
+            else:
+                buffer.append(token)
+                size += len(token)
+                if size >= max_chars:
+                    yield "".join(buffer)
+                    buffer, size, deadline = [], 0, None
+                elif deadline is None:
+                    deadline = loop.time() + window_seconds
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        # the tokens iterator is closed so it can release its resources when tokens are no longer consumed (eg: client
+        # disconnected). If it is running, cancelling it is enough, otherwise it is closed in a separate task since
+        # this one may be cancelled.
+        if not next_token.done():
+            next_token.cancel()
+        elif hasattr(it, "aclose"):
+            asyncio.ensure_future(it.aclose())
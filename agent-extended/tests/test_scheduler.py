@@ -0,0 +1,148 @@
+import asyncio
+import contextlib
+from typing import AsyncIterator, Dict, List
+
+import httpx
+
+from gpt_agent.scheduler import Admission, LlmScheduler
+
+
+class _Calls:
+    # runs LLM calls through the scheduler, recording the order in which they are granted and keeping them in flight
+    # until released
+
+    def __init__(self, scheduler: LlmScheduler):
+        self.scheduler = scheduler
+        self.granted: List[str] = []
+        self.admissions: Dict[str, Admission] = {}
+        self._releases: Dict[str, asyncio.Event] = {}
+        self.tasks: List[asyncio.Task] = []
+
+    async def start(self, name: str, user: str, tokens: int = 0) -> None:
+        self._releases[name] = asyncio.Event()
+        self.tasks.append(asyncio.create_task(self._call(name, user, tokens)))
+        # let the call be queued
+        await asyncio.sleep(0)
+
+    async def _call(self, name: str, user: str, tokens: int) -> None:
+        async with self.scheduler.admission(user, tokens) as admission:
+            self.admissions[name] = admission
+            await admission.wait()
+            self.granted.append(name)
+            await self._releases[name].wait()
+
+    async def release(self, name: str) -> None:
+        self._releases[name].set()
+        await asyncio.sleep(0.01)
+
+    async def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+@contextlib.asynccontextmanager
+async def _calls(max_concurrency: int = 10, max_per_user: int = 10, tokens_per_minute: int = 0) \
+        -> AsyncIterator[_Calls]:
+    ret = _Calls(LlmScheduler(max_concurrency, max_per_user, tokens_per_minute))
+    try:
+        yield ret
+    finally:
+        await ret.close()
+
+
+def test_admits_users_in_round_robin_order():
+    async def run():
+        async with _calls(max_concurrency=1) as calls:
+            await calls.start("a1", "a")
+            await calls.start("a2", "a")
+            await calls.start("a3", "a")
+            await calls.start("b1", "b")
+            assert calls.granted == ["a1"]
+            assert [calls.admissions[name].position for name in ["a2", "b1", "a3"]] == [1, 2, 3]
+            for name in ["a1", "a2", "b1"]:
+                await calls.release(name)
+            assert calls.granted == ["a1", "a2", "b1", "a3"]
+
+    asyncio.run(run())
+
+
+def test_limits_calls_per_user():
+    async def run():
+        async with _calls(max_per_user=2) as calls:
+            await calls.start("a1", "a")
+            await calls.start("a2", "a")
+            await calls.start("a3", "a")
+            await calls.start("b1", "b")
+            assert calls.granted == ["a1", "a2", "b1"]
+            await calls.release("b1")
+            assert calls.granted == ["a1", "a2", "b1"]
+            await calls.release("a1")
+            assert calls.granted == ["a1", "a2", "b1", "a3"]
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiting_call_frees_its_place():
+    async def run():
+        async with _calls(max_concurrency=1) as calls:
+            await calls.start("a1", "a")
+            await calls.start("b1", "b")
+            await calls.start("c1", "c")
+            calls.tasks[1].cancel()
+            await asyncio.sleep(0)
+            assert calls.admissions["c1"].position == 1
+            await calls.release("a1")
+            assert calls.granted == ["a1", "c1"]
+
+    asyncio.run(run())
+
+
+def test_token_bucket_delays_calls_until_refilled():
+    async def run():
+        # 6000 tokens per minute refills 1 token every 10ms
+        async with _calls(tokens_per_minute=6000) as calls:
+            await calls.start("a1", "a", 6000)
+            await calls.start("b1", "b", 10)
+            assert calls.granted == ["a1"]
+            await asyncio.sleep(0.15)
+            assert calls.granted == ["a1", "b1"]
+
+    asyncio.run(run())
+
+
+def test_token_bucket_caps_call_tokens_to_capacity():
+    async def run():
+        async with _calls(tokens_per_minute=6000) as calls:
+            await calls.start("a1", "a", 10000)
+            assert calls.granted == ["a1"]
+            assert calls.admissions["a1"].tokens == 6000
+
+    asyncio.run(run())
+
+
+def test_token_bucket_does_not_let_small_calls_starve_big_ones():
+    async def run():
+        async with _calls(tokens_per_minute=6000) as calls:
+            await calls.start("a1", "a", 6000)
+            await calls.start("b1", "b", 30)
+            await calls.start("c1", "c", 1)
+            await asyncio.sleep(0.1)
+            assert calls.granted == ["a1"]
+            await asyncio.sleep(0.3)
+            assert calls.granted == ["a1", "b1", "c1"]
+
+    asyncio.run(run())
+
+
+def test_rate_limited_response_pauses_admissions():
+    async def run():
+        async with _calls() as calls:
+            await calls.scheduler.track_response(httpx.Response(429, headers={"retry-after": "0.2"}))
+            await calls.start("a1", "a")
+            await asyncio.sleep(0.1)
+            assert calls.granted == []
+            await asyncio.sleep(0.2)
+            assert calls.granted == ["a1"]
+
+    asyncio.run(run())
@@ -1,24 +1,28 @@
 from typing import List, Optional
 import uuid
 
-from fastapi import FastAPI, status
-from fastapi.responses import FileResponse, Response
+from fastapi import FastAPI, Request, status
+from fastapi.responses import Response
 from pydantic import BaseModel, Field
 
+from static_assets import StaticAsset
+
 import uvicorn
 
 
 app = FastAPI()
+manifest = StaticAsset.from_file('manifest.json')
+logo = StaticAsset.from_file('logo.png')
 
 
 @app.get('/manifest.json')
-async def get_manifest() -> Response:
-    return FileResponse('manifest.json')
+async def get_manifest(request: Request) -> Response:
+    return manifest.response(request)
 
 
 @app.get('/logo.png')
-async def get_logo() -> Response:
-    return FileResponse('logo.png')
+async def get_logo(request: Request) -> Response:
+    return logo.response(request)
 
 
 class SessionBase(BaseModel):
@@ -5,25 +5,29 @@ from typing import List, Optional
 
 import dotenv
 import uvicorn
-from fastapi import FastAPI, status
-from fastapi.responses import FileResponse, Response
+from fastapi import FastAPI, Request, status
+from fastapi.responses import Response
 from langchain.agents import AgentExecutor
 from langchain.agents.agent_toolkits import create_conversational_retrieval_agent
 from langchain.tools import tool
 from langchain_community.chat_models import ChatOpenAI, AzureChatOpenAI
 from pydantic import BaseModel, Field
 
+from static_assets import StaticAsset
+
 app = FastAPI()
+manifest = StaticAsset.from_file('manifest.json')
+logo = StaticAsset.from_file('logo.png')
 
 
 @app.get('/manifest.json')
-async def get_manifest() -> Response:
-    return FileResponse('manifest.json')
+async def get_manifest(request: Request) -> Response:
+    return manifest.response(request)
 
 
 @app.get('/logo.png')
-async def get_logo() -> Response:
-    return FileResponse('logo.png')
+async def get_logo(request: Request) -> Response:
+    return logo.response(request)
 
 
 class SessionBase(BaseModel):
@@ -1,3 +1,4 @@
+import os
 import sys
 
 import dotenv
@@ -5,4 +6,9 @@ import uvicorn
 
 if __name__ == "__main__":
     dotenv.load_dotenv()
-    uvicorn.run("gpt_agent.api:app", host="0.0.0.0", port=8001, log_level="info", reload=len(sys.argv) > 1)
+    workers = int(os.getenv("WORKERS", "1"))
+    if workers > 1:
+        # questions on the same session may be handled by different workers
+        os.environ.setdefault("SESSION_LOCKS", "file")
+    uvicorn.run("gpt_agent.api:app", host="0.0.0.0", port=8001, log_level="info", reload=len(sys.argv) > 1,
+                workers=workers)
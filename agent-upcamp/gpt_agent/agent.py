@@ -1,82 +1,207 @@
 import asyncio
+import contextlib
 import datetime
-import enum
+import functools
 import logging
 import os
-from typing import List, AsyncIterator, Optional
-from pydantic import BaseModel
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
 
-from langchain.agents import Tool, OpenAIFunctionsAgent, AgentExecutor
-from langchain.callbacks import AsyncIteratorCallbackHandler
-from langchain.memory import ConversationBufferMemory, FileChatMessageHistory
+from langchain.agents import OpenAIFunctionsAgent, AgentExecutor, create_openai_tools_agent
+from langchain.agents.agent import RunnableAgent
+from langchain.callbacks.base import AsyncCallbackHandler, BaseCallbackHandler
+from langchain.memory import ConversationBufferMemory
+from langchain.memory.chat_memory import BaseChatMemory
 from langchain.prompts import MessagesPlaceholder
-from langchain.schema import SystemMessage
-from langchain.tools import tool
+from langchain.schema import HumanMessage, SystemMessage
+from langchain.tools import BaseTool
+from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_community.chat_models import AzureChatOpenAI, ChatOpenAI
-from openai import OpenAI, AzureOpenAI
+from openai import AsyncOpenAI, AsyncAzureOpenAI
 
+from gpt_agent import http_clients, metrics
+from gpt_agent.answer_cache import answer_cache, CachedAnswer
 from gpt_agent.domain import Session
-from gpt_agent.file_system_repos import get_session_path
+from gpt_agent.flows import AgentFlow, FlowChannel, load_flow_tools, set_flow_channel
+from gpt_agent.file_system_repos import get_session_path, JsonLinesChatMessageHistory
+from gpt_agent.interactions import InteractionsBatcher
+from gpt_agent.locks import session_locks
+from gpt_agent.memory import BackgroundSummaryBufferMemory, estimate_tokens
+from gpt_agent.scheduler import llm_scheduler, QueueStatus
+from gpt_agent.streaming import ToolEvent, ToolStatus
+from gpt_agent.tools import async_tool, is_tool_error
 
 logging.getLogger("openai").level = logging.DEBUG
 
+QUEUE_STATUS_INTERVAL_SECONDS = float(os.getenv("QUEUE_STATUS_INTERVAL_SECONDS", "1"))
+INTERACTIONS_PROMPT = ("You summarize interactions of a user with a web application, which are provided as JSON "
+                       "contents of requests done by the application. Briefly describe, in {locale} locale, what the "
+                       "user did in the new interactions, without repeating what the previous summary describes.")
+
 
 # just a sample tool to showcase how you can create your own set of tools
-@tool
-def clock() -> str:
+@async_tool()
+async def clock() -> str:
     """gets the current time"""
     return str(datetime.datetime.now())
 
 
-class AgentAction(enum.Enum):
-    MESSAGE = "message"
-    CLICK = "click"
-    FILL = "fill"
-    GOTO = "goto"
+# flows to automate navigation in the browser, like the sample contact_abstracta one, are defined in flows.json
+flow_tools = load_flow_tools(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'assets', 'flows.json'))
 
 
-class AgentStep(BaseModel):
-    action: AgentAction
-    selector: Optional[str] = None
-    value: Optional[str] = None
+class ToolsMetricsCallbackHandler(AsyncCallbackHandler):
 
+    def __init__(self):
+        self._starts: Dict[uuid.UUID, Tuple[str, float]] = {}
+        self.tool_calls = 0
 
-class AgentFlow(BaseModel):
-    steps: List[AgentStep]
+    async def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: uuid.UUID,
+                            **kwargs: Any) -> None:
+        self._starts[run_id] = (serialized.get("name", ""), time.perf_counter())
+        self.tool_calls += 1
+
+    async def on_tool_end(self, output: str, *, run_id: uuid.UUID, **kwargs: Any) -> None:
+        self._record(run_id, is_tool_error(output))
+
+    async def on_tool_error(self, error: BaseException, *, run_id: uuid.UUID, **kwargs: Any) -> None:
+        self._record(run_id, True)
+
+    def _record(self, run_id: uuid.UUID, failed: bool) -> None:
+        start = self._starts.pop(run_id, None)
+        if start:
+            metrics.tool_seconds.observe(time.perf_counter() - start[1], start[0])
+            if failed:
+                metrics.tool_errors.inc(1, start[0])
+
+
+class AgentEventsCallbackHandler(AsyncCallbackHandler):
+    # Streams tokens of all LLM calls of an agent run, and tool events, until the run ends. Unlike
+    # AsyncIteratorCallbackHandler, which stops on the first LLM call end, it streams the answer generated after using
+    # tools, and lets clients know what the agent is doing meanwhile.
+
+    def __init__(self):
+        self._queue: asyncio.Queue[str | ToolEvent | None] = asyncio.Queue()
+        self._tools: Dict[uuid.UUID, str] = {}
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        # tool calls are streamed as empty tokens
+        if token:
+            self._queue.put_nowait(token)
+
+    async def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: uuid.UUID,
+                            **kwargs: Any) -> None:
+        tool = serialized.get("name", "")
+        self._tools[run_id] = tool
+        self._queue.put_nowait(ToolEvent(tool=tool, status=ToolStatus.STARTED))
+
+    async def on_tool_end(self, output: str, *, run_id: uuid.UUID, **kwargs: Any) -> None:
+        self._tool_event(run_id, ToolStatus.FAILED if is_tool_error(output) else ToolStatus.FINISHED)
+
+    async def on_tool_error(self, error: BaseException, *, run_id: uuid.UUID, **kwargs: Any) -> None:
+        self._tool_event(run_id, ToolStatus.FAILED)
+
+    def _tool_event(self, run_id: uuid.UUID, status: ToolStatus) -> None:
+        tool = self._tools.pop(run_id, None)
+        if tool is not None:
+            self._queue.put_nowait(ToolEvent(tool=tool, status=status))
+
+    def close(self, *_: Any) -> None:
+        self._queue.put_nowait(None)
+
+    async def aiter(self) -> AsyncIterator[str | ToolEvent]:
+        item: Optional[str | ToolEvent]
+        while (item := await self._queue.get()) is not None:
+            yield item
+
+
+def _is_azure(base_url: str) -> bool:
+    return base_url and ".openai.azure.com" in base_url
+
+
+# LLM clients (and their underlying HTTP connection pools) are shared by all agents using the same model configuration
+@functools.lru_cache(maxsize=None)
+def _get_llm(base_url: Optional[str], deployment_name: Optional[str], model_name: Optional[str],
+             temperature: float) -> ChatOpenAI:
+    max_retries = int(os.getenv("LLM_MAX_RETRIES", "2"))
+    if _is_azure(base_url):
+        ret = AzureChatOpenAI(deployment_name=deployment_name, temperature=temperature, verbose=True, streaming=True,
+                              max_retries=max_retries)
+    else:
+        ret = ChatOpenAI(model_name=model_name, temperature=temperature, verbose=True, streaming=True,
+                         max_retries=max_retries)
+    # responses are checked by the scheduler to stop admitting LLM calls while OpenAI quota is exceeded. The client is
+    # replaced through the private _client of the completions resource built by langchain-community 0.0.x (pinned in
+    # pyproject.toml), since its http_client parameter is used for both sync and async OpenAI clients, and Azure model
+    # always builds its own async client. Review it when upgrading langchain-community.
+    http_client = http_clients.build_client(response_hooks=[llm_scheduler.track_response])
+    ret.async_client = ret.async_client._client.with_options(http_client=http_client,
+                                                             timeout=http_clients.TIMEOUT).chat.completions
+    return ret
 
-    @staticmethod
-    def message(text: str) -> 'AgentFlow':
-        return AgentFlow(steps=[AgentStep(action=AgentAction.MESSAGE, value=text)])
 
+@functools.lru_cache(maxsize=None)
+def _get_whisper_client(base_url: Optional[str], api_key: Optional[str], api_version: Optional[str],
+                        deployment_name: Optional[str]) -> AsyncOpenAI:
+    if _is_azure(base_url):
+        return AsyncAzureOpenAI(azure_endpoint=base_url, api_version=api_version, api_key=api_key,
+                                azure_deployment=deployment_name, http_client=http_clients.build_client(),
+                                timeout=http_clients.TIMEOUT)
+    else:
+        return AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=http_clients.build_client(),
+                           timeout=http_clients.TIMEOUT)
 
-# a sample tool to showcase how you can automate navigation in the browser
-@tool(return_direct=True)
-def contact_abstracta(full_name: str) -> str:
-    """navigates to abstracta.us and fills the contact form with the given full name"""
-    return AgentFlow(steps=[
-        AgentStep(action=AgentAction.GOTO, value='https://abstracta.us'),
-        AgentStep(action=AgentAction.CLICK, selector='xpath://a[@href="./contact-us"]'),
-        AgentStep(action=AgentAction.FILL, selector='#fullname', value=full_name),
-        AgentStep(action=AgentAction.MESSAGE, value="I have filled the contact form with your name.")
-    ]).model_dump_json()
+
+def _only_return_direct_action(output: Any, return_direct_tools: Set[str]) -> Any:
+    if isinstance(output, list):
+        return_direct = [action for action in output if action.tool in return_direct_tools]
+        if return_direct:
+            return return_direct[:1]
+    return output
 
 
 class Agent:
 
     def __init__(self, session: Session):
         self._session = session
-        message_history = FileChatMessageHistory(get_session_path(session.id) + "/chat_history.json")
-        self._memory = ConversationBufferMemory(memory_key="chat_history", chat_memory=message_history,
-                                                return_messages=True)
-        self._agent = self._build_agent(self._memory, [clock, contact_abstracta])
+        session_path = get_session_path(session.id)
+        self._history = JsonLinesChatMessageHistory(session_path)
+        self._memory = self._build_memory(session_path, self._history)
+        self._agent = self._build_agent(self._memory, [clock, *flow_tools])
+        self._interactions = InteractionsBatcher(self._summarize_interactions)
+
+    @staticmethod
+    def _build_llm() -> ChatOpenAI:
+        return _get_llm(os.getenv("OPENAI_API_BASE"), os.getenv("AZURE_DEPLOYMENT_NAME"), os.getenv("MODEL_NAME"),
+                        float(os.getenv("TEMPERATURE")))
 
-    def _build_agent(self, memory: ConversationBufferMemory, tools: List[Tool]) -> AgentExecutor:
+    def _build_memory(self, session_path: str, message_history: BaseChatMessageHistory) -> BaseChatMemory:
+        max_tokens = os.getenv("AGENT_MEMORY_MAX_TOKENS")
+        if max_tokens:
+            return BackgroundSummaryBufferMemory.load(session_path, llm=self._build_llm(),
+                                                      user=self._session.user or str(self._session.id),
+                                                      max_token_limit=int(max_tokens), memory_key="chat_history",
+                                                      chat_memory=message_history, return_messages=True)
+        return ConversationBufferMemory(memory_key="chat_history", chat_memory=message_history, return_messages=True)
+
+    def _build_agent(self, memory: BaseChatMemory, tools: List[BaseTool]) -> AgentExecutor:
         llm = self._build_llm()
         prompt = OpenAIFunctionsAgent.create_prompt(
             system_message=SystemMessage(content=os.getenv("SYSTEM_PROMPT")),
             extra_prompt_messages=[MessagesPlaceholder(variable_name=memory.memory_key)],
         )
-        agent = OpenAIFunctionsAgent(llm=llm, tools=tools, prompt=prompt)
+        # tools agent allows the LLM to request several tool calls in one step, which are run concurrently, while
+        # functions agent only supports one call per step (but works with Azure API versions previous to 2023-12-01)
+        if os.getenv("AGENT_PARALLEL_TOOLS", "false") == "true":
+            # wrapped as single action agent since executor doesn't allow return direct tools (like contact_abstracta)
+            # in multi action agents, but still runs concurrently all tool calls returned by the agent. Executor only
+            # returns directly steps with one action, so return direct tools are run alone
+            return_direct_tools = {t.name for t in tools if t.return_direct}
+            agent = RunnableAgent(runnable=create_openai_tools_agent(llm, tools, prompt) | functools.partial(
+                _only_return_direct_action, return_direct_tools=return_direct_tools))
+        else:
+            agent = OpenAIFunctionsAgent(llm=llm, tools=tools, prompt=prompt)
         return AgentExecutor(
             agent=agent,
             tools=tools,
@@ -86,52 +211,135 @@ class Agent:
             max_iterations=int(os.getenv("AGENT_MAX_ITERATIONS", "3"))
         )
 
-    def _build_llm(self):
-        temperature = float(os.getenv("TEMPERATURE"))
-        base_url = os.getenv("OPENAI_API_BASE")
-        if self._is_azure(base_url):
-            return AzureChatOpenAI(deployment_name=os.getenv("AZURE_DEPLOYMENT_NAME"), temperature=temperature,
-                                   verbose=True, streaming=True)
-        else:
-            return ChatOpenAI(model_name=os.getenv("MODEL_NAME"), temperature=temperature, verbose=True, streaming=True)
-
-    @staticmethod
-    def _is_azure(base_url: str) -> bool:
-        return base_url and ".openai.azure.com" in base_url
-
     def start_session(self):
         self._memory.chat_memory.add_user_message("this is my locale: " + self._session.locales[0])
 
-    def transcript(self, audio_file_path: str) -> str:
-        base_url = os.getenv("OPENAI_WHISPER_API_BASE", os.getenv("OPENAI_API_BASE"))
-        api_key = os.getenv("OPENAI_WHISPER_API_KEY", os.getenv("OPENAI_API_KEY"))
-        api_version = os.getenv("OPENAI_WHISPER_API_VERSION", os.getenv("OPENAI_API_VERSION"))
-        deployment_name = os.getenv("AZURE_WHISPER_DEPLOYMENT_NAME", os.getenv("AZURE_DEPLOYMENT_NAME"))
-        client = AzureOpenAI(azure_endpoint=base_url, api_version=api_version, api_key=api_key,
-                             azure_deployment=deployment_name) \
-            if self._is_azure(base_url) else OpenAI(base_url=base_url, api_key=api_key)
+    async def transcript(self, audio: bytes) -> str:
+        client = _get_whisper_client(os.getenv("OPENAI_WHISPER_API_BASE", os.getenv("OPENAI_API_BASE")),
+                                     os.getenv("OPENAI_WHISPER_API_KEY", os.getenv("OPENAI_API_KEY")),
+                                     os.getenv("OPENAI_WHISPER_API_VERSION", os.getenv("OPENAI_API_VERSION")),
+                                     os.getenv("AZURE_WHISPER_DEPLOYMENT_NAME", os.getenv("AZURE_DEPLOYMENT_NAME")))
         locale = self._session.locales[0]
         lang_separator_pos = locale.find("-")
         language = locale[0:lang_separator_pos] if lang_separator_pos >= 0 else locale
-        ret = client.audio.transcriptions.create(model="whisper-1", file=open(audio_file_path, 'rb'),
-                                                 language=language)
+        with metrics.transcription_seconds.time():
+            ret = await client.audio.transcriptions.create(model="whisper-1", file=("audio.webm", audio),
+                                                           language=language)
         return ret.text
 
-    async def ask(self, question: str) -> AsyncIterator[AgentFlow | str]:
-        callback = AsyncIteratorCallbackHandler()
-        task = asyncio.create_task(self._agent.arun(input=question, callbacks=[callback]))
-        resp = ""
-        async for token in callback.aiter():
-            resp += token
-            yield token
-        ret = await task
-        # when using tools tokens are not passed to the callback handler, so we need to get the response directly from
-        # agent run call
-        if ret != resp:
-            if ret.startswith("{\"steps\":"):
-                try:
-                    yield AgentFlow.model_validate_json(ret)
-                except Exception as e:
-                    logging.exception("Error parsing agent response", e)
-                    yield ret
-            yield ret
+    async def ask(self, question: str) -> AsyncIterator[AgentFlow | QueueStatus | ToolEvent | str]:
+        async with self._synced_history():
+            async for item in self._answer(question):
+                yield item
+
+    @contextlib.asynccontextmanager
+    async def _synced_history(self) -> AsyncIterator[None]:
+        async with session_locks.lock(self._session.id):
+            # pending writes are completed before refreshing to avoid reading them as messages added by other processes
+            await self._history.aflush()
+            self._history.refresh()
+            try:
+                yield
+            finally:
+                # history is written before releasing the lock, so next question (in any process) gets it complete
+                await self._history.aflush()
+
+    async def _answer(self, question: str) -> AsyncIterator[AgentFlow | QueueStatus | ToolEvent | str]:
+        cache_key = answer_cache.build_key(question, self._memory.chat_memory.messages, os.getenv("SYSTEM_PROMPT"),
+                                           os.getenv("AZURE_DEPLOYMENT_NAME") or os.getenv("MODEL_NAME"),
+                                           float(os.getenv("TEMPERATURE")))
+        cached = answer_cache.get(cache_key)
+        if cached:
+            self._memory.save_context({"input": question}, {"output": cached.output})
+            for item in cached.items:
+                yield AgentFlow.model_validate(item["flow"]) if isinstance(item, dict) else item
+            return
+        # sessions without user (when no authentication is used) are considered from different users
+        user = self._session.user or str(self._session.id)
+        async with llm_scheduler.admission(user, self._estimate_prompt_tokens(question)) as admission:
+            while not admission.granted:
+                yield QueueStatus(position=admission.position)
+                await admission.wait(QUEUE_STATUS_INTERVAL_SECONDS)
+            async for item in self._run(question, cache_key):
+                yield item
+
+    async def process_interaction(self, detail: Any) -> Optional[str]:
+        return await self._interactions.add(detail)
+
+    async def _summarize_interactions(self, interactions: List[str], previous_summary: Optional[str]) -> str:
+        messages = [SystemMessage(content=INTERACTIONS_PROMPT.format(locale=self._session.locales[0])),
+                    HumanMessage(content=f"Previous summary: {previous_summary or 'none'}\nNew interactions:\n"
+                                         + "\n".join(interactions))]
+        user = self._session.user or str(self._session.id)
+        async with llm_scheduler.admission(user, sum(estimate_tokens(m.content) for m in messages)) as admission:
+            while not admission.granted:
+                await admission.wait(QUEUE_STATUS_INTERVAL_SECONDS)
+            with metrics.interactions_summary_seconds.time():
+                ret = (await self._build_llm().ainvoke(messages)).content
+        # summaries are shown to the user as agent messages, so they are kept in chat history as context for questions
+        async with self._synced_history():
+            self._history.add_ai_message(ret)
+        return ret
+
+    def _estimate_prompt_tokens(self, question: str) -> int:
+        history = self._memory.load_memory_variables({})[self._memory.memory_key]
+        return (estimate_tokens(os.getenv("SYSTEM_PROMPT")) + sum(estimate_tokens(m.content) for m in history)
+                + estimate_tokens(question))
+
+    async def _run(self, question: str, cache_key: Optional[str]) -> AsyncIterator[AgentFlow | ToolEvent | str]:
+        events = AgentEventsCallbackHandler()
+        tools_callback = ToolsMetricsCallbackHandler()
+        flows = FlowChannel()
+        task = asyncio.create_task(self._invoke(question, flows, [events, tools_callback]))
+        # events stream ends when the agent run ends, even if it fails before generating any token
+        task.add_done_callback(events.close)
+        try:
+            items = []
+            resp_tokens = []
+            tokens = 0
+            async for event in events.aiter():
+                if isinstance(event, ToolEvent):
+                    # text generated before using tools is not part of the output returned by the agent
+                    resp_tokens.clear()
+                    yield event
+                    continue
+                resp_tokens.append(event)
+                tokens += 1
+                items.append(event)
+                yield event
+            resp = "".join(resp_tokens)
+            ret = await task
+            metrics.answer_tokens.observe(tokens)
+            for flow in flows.flows:
+                items.append({"flow": flow.model_dump(mode="json")})
+                yield flow
+            # output of return direct tools is not generated by the LLM, so we need to get the response directly from
+            # agent run call, unless it is the result of a flow tool which has already been sent as flow
+            if ret != resp and ret != flows.last_output:
+                items.append(ret)
+                yield ret
+            # answers involving tools are not cached since tools may depend on current state (eg: current time)
+            if cache_key and not tools_callback.tool_calls:
+                await answer_cache.put(cache_key, CachedAnswer(items=items, output=ret))
+        finally:
+            # stops the agent, and any in progress request to the LLM, when the answer is abandoned (eg: client
+            # disconnected), to avoid spending tokens and storing in memory an answer nobody received
+            task.cancel()
+
+    async def _invoke(self, question: str, flows: FlowChannel, callbacks: List[BaseCallbackHandler]) -> str:
+        # the channel is set in the agent task context, so it is available to tools without affecting the caller one
+        set_flow_channel(flows)
+        ret = await self._agent.ainvoke({"input": question}, config={"callbacks": callbacks})
+        return ret["output"]
+
+
+async def warm_up() -> None:
+    # builds the LLM client, and opens a connection to the LLM API, so the first question doesn't pay for them
+    llm = Agent._build_llm()
+    if os.getenv("WARM_UP_LLM_CONNECTION", "true") != "true":
+        return
+    try:
+        # any response is fine, since the point is having an open connection in the client pool
+        await llm.async_client._client.with_options(max_retries=0).models.list()
+    except Exception as e:
+        logging.info("LLM API connection warm up got: %s", e)
@@ -0,0 +1,53 @@
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Tuple, TYPE_CHECKING
+
+from gpt_agent import metrics
+from gpt_agent.domain import Session
+
+if TYPE_CHECKING:
+    from gpt_agent.agent import Agent
+
+
+class AgentPool:
+    # keeps agents of active sessions around so consecutive questions on the same session reuse the already built
+    # agent executor, prompt and loaded chat history instead of building them on each request
+
+    def __init__(self, max_size: int, idle_ttl_seconds: float):
+        self._max_size = max_size
+        self._idle_ttl_seconds = idle_ttl_seconds
+        self._agents: OrderedDict[uuid.UUID, Tuple['Agent', float]] = OrderedDict()
+
+    def get(self, session: Session) -> 'Agent':
+        now = time.monotonic()
+        self._evict_idle(now)
+        entry = self._agents.pop(session.id, None)
+        if entry:
+            agent = entry[0]
+        else:
+            # imported on demand since it takes most of the startup time, and it is imported in background on startup
+            from gpt_agent.agent import Agent
+            with metrics.agent_construction_seconds.time():
+                agent = Agent(session)
+        self._agents[session.id] = (agent, now)
+        while len(self._agents) > self._max_size:
+            self._agents.popitem(last=False)
+        return agent
+
+    def _evict_idle(self, now: float) -> None:
+        while self._agents:
+            _, last_access = next(iter(self._agents.values()))
+            if now - last_access <= self._idle_ttl_seconds:
+                break
+            self._agents.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._agents)
+
+
+agent_pool = AgentPool(max_size=int(os.getenv("AGENT_POOL_SIZE", "200")),
+                       idle_ttl_seconds=float(os.getenv("AGENT_POOL_IDLE_TTL_SECONDS", "900")))
+metrics.CallbackGauge("gpt_agent_pooled_agents", "Number of session agents in the agents pool",
+                      lambda: len(agent_pool))
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+import aiofiles
+from langchain.schema import BaseMessage
+
+from gpt_agent import metrics
+from gpt_agent.cache import LruCache
+
+
+@dataclass
+class CachedAnswer:
+    # items as yielded by the agent: answer tokens (str) or flows serialized as json (dict with "flow" key)
+    items: List[str | dict]
+    output: str
+
+
+class AnswerCache:
+    # caches answers to questions asked with the same configuration and chat history (by default only to the first
+    # question of a session), which avoids sending to the LLM the same prompt template questions sent by many users.
+
+    def __init__(self, max_size: int, ttl_seconds: float, max_history_messages: int, file_path: Optional[str]):
+        self._cache: LruCache[CachedAnswer] = LruCache(max_size, ttl_seconds)
+        self._max_size = max_size
+        self._ttl_seconds = ttl_seconds
+        self._max_history_messages = max_history_messages
+        self._file_path = file_path
+        if self.enabled and file_path and os.path.exists(file_path):
+            self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_size > 0
+
+    def build_key(self, question: str, history: Sequence[BaseMessage], system_prompt: str, model: str,
+                  temperature: float) -> Optional[str]:
+        if not self.enabled or len(history) > self._max_history_messages:
+            return None
+        # only whitespace is normalized since casing may be relevant in questions including code
+        normalized = " ".join(question.split())
+        history_fingerprint = [(message.type, message.content) for message in history]
+        return hashlib.sha256(json.dumps([normalized, system_prompt, model, temperature, history_fingerprint])
+                              .encode()).hexdigest()
+
+    def get(self, key: Optional[str]) -> Optional[CachedAnswer]:
+        if key is None:
+            return None
+        ret = self._cache.get(key)
+        if ret:
+            metrics.answer_cache_hits.inc()
+        else:
+            metrics.answer_cache_misses.inc()
+        return ret
+
+    async def put(self, key: str, answer: CachedAnswer) -> None:
+        self._cache.put(key, answer)
+        if self._file_path:
+            async with aiofiles.open(self._file_path, "a", encoding="utf-8") as f:
+                await f.write(self._serialize(key, answer, time.time()) + "\n")
+
+    @staticmethod
+    def _serialize(key: str, answer: CachedAnswer, created: float) -> str:
+        return json.dumps({"key": key, "created": created, "items": answer.items, "output": answer.output})
+
+    def _load(self) -> None:
+        now = time.time()
+        entries = {}
+        with open(self._file_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning("Skipping invalid answer cache entry in %s", self._file_path)
+                    continue
+                if now - entry["created"] < self._ttl_seconds:
+                    entries[entry["key"]] = entry
+        live_entries = sorted(entries.values(), key=lambda e: e["created"])[-self._max_size:]
+        for entry in live_entries:
+            self._cache.put(entry["key"], CachedAnswer(items=entry["items"], output=entry["output"]),
+                            ttl_seconds=self._ttl_seconds - (now - entry["created"]))
+        # rewrite the file to discard expired and replaced entries, since new entries are just appended to it
+        with open(self._file_path, "w", encoding="utf-8") as f:
+            for entry in live_entries:
+                f.write(json.dumps(entry) + "\n")
+
+
+answer_cache = AnswerCache(max_size=int(os.getenv("ANSWER_CACHE_SIZE", "0")),
+                           ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400")),
+                           max_history_messages=int(os.getenv("ANSWER_CACHE_MAX_HISTORY_MESSAGES", "1")),
+                           file_path=os.getenv("ANSWER_CACHE_PATH"))
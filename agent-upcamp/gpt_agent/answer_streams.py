@@ -0,0 +1,153 @@
+import asyncio
+import functools
+import os
+import uuid
+from collections import deque
+from typing import AsyncIterator, Callable, Deque, Dict, Optional
+
+from sse_starlette.sse import ServerSentEvent
+
+from gpt_agent import metrics
+
+_LOST_EVENTS_ERROR = ServerSentEvent(event="error").encode()
+
+
+class AnswerStream:
+    # Generates the events of an answer in a background task and keeps the latest max_events of them. Generation waits
+    # while max_events events are pending to be read, so slow clients don't miss events, and readers falling behind
+    # discarded events (eg: a previous connection of a client that resumed the answer) get an error event. When
+    # resumable, events are identified by "<answer id>:<sequence number>", so clients which lost the connection (eg:
+    # dropped by a proxy) can read missed events and keep reading the answer, instead of asking again. To avoid spending
+    # tokens on answers nobody receives, the answer is cancelled as soon as its client disconnects, or when resumable,
+    # if no client resumes it within resume_seconds. Answers no client starts reading are cancelled after ttl_seconds.
+
+    def __init__(self, session_id: uuid.UUID, events: AsyncIterator[ServerSentEvent], max_events: int,
+                 ttl_seconds: float, resumable: bool, resume_seconds: float):
+        self.id = str(uuid.uuid4())
+        self.session_id = session_id
+        self.resumable = resumable
+        self._resume_seconds = resume_seconds
+        self._max_events = max_events
+        self._events: Deque[bytes] = deque(maxlen=max_events)
+        self._next_seq = 0
+        # sequence number of the last event read by the most advanced reader
+        self._read_seq = -1
+        self._updated = asyncio.Event()
+        self._consumed = asyncio.Event()
+        self._readers = 0
+        self._done = False
+        self._abandon_check: Optional[asyncio.TimerHandle] = None
+        self._task = asyncio.create_task(self._generate(events))
+        # the answer may be abandoned before any client starts reading it
+        self._schedule_abandon_check(ttl_seconds)
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    def add_done_callback(self, callback: Callable[[asyncio.Task], None]) -> None:
+        self._task.add_done_callback(callback)
+
+    async def _generate(self, events: AsyncIterator[ServerSentEvent]) -> None:
+        try:
+            async for event in events:
+                while self._next_seq - self._read_seq > self._max_events:
+                    self._consumed.clear()
+                    await self._consumed.wait()
+                # ids are only sent to clients supporting them, since previous extension versions expect the event
+                # type in the first line
+                if self.resumable:
+                    event.id = f"{self.id}:{self._next_seq}"
+                self._events.append(event.encode())
+                self._next_seq += 1
+                self._notify()
+        finally:
+            self._done = True
+            self._notify()
+
+    def _notify(self) -> None:
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    @property
+    def _first_seq(self) -> int:
+        return self._next_seq - len(self._events)
+
+    def can_resume(self, last_seq: int) -> bool:
+        # events after the given one may have been discarded from the buffer
+        return self._first_seq <= last_seq + 1
+
+    async def read(self, last_seq: int = -1) -> AsyncIterator[bytes]:
+        self._readers += 1
+        if self._abandon_check:
+            self._abandon_check.cancel()
+            self._abandon_check = None
+        try:
+            while True:
+                updated = self._updated
+                done = self.done
+                # events are accessed by index, which is cheap near the end of the deque where new events are
+                while last_seq + 1 < self._next_seq:
+                    first_seq = self._first_seq
+                    if last_seq + 1 < first_seq:
+                        metrics.lost_stream_events.inc()
+                        yield _LOST_EVENTS_ERROR
+                        return
+                    last_seq += 1
+                    yield self._events[last_seq - first_seq]
+                    if last_seq > self._read_seq:
+                        self._read_seq = last_seq
+                        self._consumed.set()
+                if done:
+                    break
+                await updated.wait()
+        finally:
+            self._readers -= 1
+            if not self._readers:
+                self._schedule_abandon_check(self._resume_seconds if self.resumable else 0)
+
+    def _schedule_abandon_check(self, delay_seconds: float) -> None:
+        if self.done:
+            return
+        if delay_seconds:
+            self._abandon_check = asyncio.get_running_loop().call_later(delay_seconds, self._check_abandoned)
+        else:
+            self._check_abandoned()
+
+    def _check_abandoned(self) -> None:
+        self._abandon_check = None
+        if not self._readers:
+            self._task.cancel()
+
+
+class AnswerStreams:
+    # keeps resumable answer streams in progress, and completed ones for ttl_seconds, so clients can resume reading them
+
+    def __init__(self, max_events: int, ttl_seconds: float, resume_seconds: float):
+        self._max_events = max_events
+        self._ttl_seconds = ttl_seconds
+        self._resume_seconds = resume_seconds
+        self._streams: Dict[str, AnswerStream] = {}
+
+    def start(self, session_id: uuid.UUID, events: AsyncIterator[ServerSentEvent], resumable: bool) -> AnswerStream:
+        ret = AnswerStream(session_id, events, self._max_events, self._ttl_seconds, resumable, self._resume_seconds)
+        if resumable:
+            self._streams[ret.id] = ret
+            ret.add_done_callback(functools.partial(self._schedule_removal, ret.id))
+        return ret
+
+    def _schedule_removal(self, answer_id: str, _: asyncio.Task) -> None:
+        asyncio.get_running_loop().call_later(self._ttl_seconds, self._streams.pop, answer_id, None)
+
+    def get(self, answer_id: str) -> Optional[AnswerStream]:
+        return self._streams.get(answer_id)
+
+    def __len__(self) -> int:
+        return len(self._streams)
+
+
+answer_streams = AnswerStreams(max_events=int(os.getenv("ANSWER_STREAMS_MAX_EVENTS", "1000")),
+                               ttl_seconds=float(os.getenv("ANSWER_STREAMS_TTL_SECONDS", "30")),
+                               resume_seconds=float(os.getenv("ANSWER_STREAMS_RESUME_SECONDS", "5")))
+metrics.CallbackGauge("gpt_agent_answer_streams", "Number of answer streams kept to allow resuming them",
+                      lambda: len(answer_streams))
@@ -1,53 +1,123 @@
+import asyncio
+import base64
+import importlib
+import json
 import logging
 import os
+import time
 import traceback
-from typing import AsyncIterator, Annotated, Optional
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Annotated, Optional, Set
 
-from fastapi import Depends, FastAPI, HTTPException, status, Request
-from fastapi.responses import FileResponse, StreamingResponse, Response
-from fastapi.templating import Jinja2Templates
+from fastapi import Body, Depends, FastAPI, Header, HTTPException, status, Request
+from fastapi.responses import StreamingResponse, Response
+from jinja2 import Environment, FileSystemLoader
 from pydantic import BaseModel
 from sse_starlette.sse import ServerSentEvent
 
-from gpt_agent.agent import Agent, AgentAction
-from gpt_agent.auth import get_current_user
+from gpt_agent import http_clients, metrics
+from gpt_agent.agent_pool import agent_pool
+from gpt_agent.answer_streams import answer_streams
+from gpt_agent.auth import get_current_user, openid_config
 from gpt_agent.domain import Session, Question, TranscriptionQuestion, SessionBase
-from gpt_agent.file_system_repos import SessionsRepository, QuestionsRepository, TranscriptionsRepository
+from gpt_agent.persistence import build_questions_writer
+from gpt_agent.streaming import coalesce_tokens, ToolEvent
+from gpt_agent.repos import build_repos
+from gpt_agent.retention import build_retention_sweeper
+from gpt_agent.scheduler import QueueStatus
+from gpt_agent.static_assets import StaticAsset
 
 logging.basicConfig()
 logger = logging.getLogger("gpt_agent")
 logger.level = logging.DEBUG
 logging.getLogger().level = logging.DEBUG
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # warm up runs in background so the server starts answering requests (like liveness probes) as soon as possible,
+    # and /ready tells when questions can be answered without paying for startup costs
+    warm_up_task = asyncio.create_task(_warm_up())
+    retention_sweeper.start()
+    yield
+    warm_up_task.cancel()
+    await retention_sweeper.stop()
+    await questions_writer.stop()
+    if openid_config:
+        await openid_config.stop()
+    await http_clients.close()
+
+
+async def _warm_up() -> None:
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(_warm_up_agent(), *([openid_config.start()] if openid_config else []))
+    except Exception as e:
+        logging.exception("Error warming up", exc_info=e)
+        return
+    metrics.warm_up_seconds.set(time.perf_counter() - start)
+    warmed_up.set()
+
+
+async def _warm_up_agent() -> None:
+    # agent module (which imports langchain and openai) is imported in a thread to avoid blocking the event loop
+    agent = await asyncio.to_thread(importlib.import_module, "gpt_agent.agent")
+    await agent.warm_up()
+
+
+warmed_up = asyncio.Event()
+app = FastAPI(lifespan=lifespan)
 assets_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'assets')
-templates = Jinja2Templates(directory=assets_path)
-sessions_repo = SessionsRepository()
-questions_repo = QuestionsRepository()
-transcriptions_repo = TranscriptionsRepository()
+sessions_repo, questions_repo, transcriptions_repo = build_repos()
+questions_writer = build_questions_writer(questions_repo)
+retention_sweeper = build_retention_sweeper(sessions_repo, questions_repo, transcriptions_repo)
+
+
+def _render_manifest() -> bytes:
+    # configuration values are rendered with tojson filter, so quotes or backslashes in them don't break the manifest
+    ret = Environment(loader=FileSystemLoader(assets_path)).get_template("manifest.json").render(
+        openid_url=os.getenv("MANIFEST_OPENID_URL", os.getenv("OPENID_URL")),
+        openid_client_id=os.getenv("OPENID_CLIENT_ID"),
+        openid_scope=os.getenv("OPENID_SCOPE"),
+        contact_email=os.getenv("CONTACT_EMAIL"))
+    # fails on startup instead of serving an invalid manifest to the extension
+    json.loads(ret)
+    return ret.encode()
+
+
+# manifest depends only on configuration, so it is rendered once on startup
+ASSETS_MAX_AGE_SECONDS = int(os.getenv("ASSETS_MAX_AGE_SECONDS", "300"))
+manifest = StaticAsset(_render_manifest(), "application/json", ASSETS_MAX_AGE_SECONDS)
+logo = StaticAsset.from_file(os.path.join(assets_path, 'logo.png'), max_age_seconds=ASSETS_MAX_AGE_SECONDS)
 
 
 @app.get('/manifest.json')
 async def get_manifest(request: Request) -> Response:
-    return templates.TemplateResponse("manifest.json", {
-        "request": request,
-        "openid_url": os.getenv("MANIFEST_OPENID_URL", os.getenv("OPENID_URL")),
-        "openid_client_id": os.getenv("OPENID_CLIENT_ID"),
-        "openid_scope": os.getenv("OPENID_SCOPE"),
-        "contact_email": os.getenv("CONTACT_EMAIL")
-    }, media_type='application/json')
+    return manifest.response(request)
+
+
+@app.get('/metrics')
+async def get_metrics() -> Response:
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get('/ready')
+async def get_ready() -> Response:
+    if not warmed_up.is_set():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='warming up')
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
 @app.get('/logo.png')
-async def get_logo() -> FileResponse:
-    return FileResponse(os.path.join(assets_path, 'logo.png'))
+async def get_logo(request: Request) -> Response:
+    return logo.response(request)
 
 
 @app.post('/sessions', status_code=status.HTTP_201_CREATED)
 async def create_session(req: SessionBase, user: Annotated[str, Depends(get_current_user)]) -> Session:
     ret = Session(**req.model_dump(), user=user)
     await sessions_repo.save_session(ret)
-    Agent(ret).start_session()
+    agent_pool.get(ret).start_session()
     return ret
 
 
@@ -55,42 +125,120 @@ class QuestionRequest(BaseModel):
     question: Optional[str] = ""
 
 
+def _parse_answer_events(header: Optional[str]) -> Set[str]:
+    return {e.strip() for e in header.split(",")} if header else set()
+
+
+# Extensions previous to status and tool events parse any named event as a flow, and expect the event type in the first
+# line of events, so such events and event ids (required to resume answers) are only sent to clients listing them in
+# Answer-Events header (eg: "Answer-Events: status, tool, resume")
 @app.post('/sessions/{session_id}/questions')
-async def answer_question(
-        session_id: str, req: QuestionRequest, user: Annotated[str, Depends(get_current_user)]) -> StreamingResponse:
+async def answer_question(session_id: str, req: QuestionRequest, user: Annotated[str, Depends(get_current_user)],
+                          answer_events: Annotated[Optional[str], Header()] = None) -> StreamingResponse:
     session = await _find_session(session_id, user)
     # This copilot uses response streaming which allows users to start get a response as soon as
     # possible, which is particularly important when interacting with LLMs that support response
     # streaming and may take some time to end answering a given response.
     # If you don't want to use response streaming you can just return a pydantic object like in
     # create session endpoint.
-    return StreamingResponse(agent_response_stream(req, session), media_type="text/event-stream")
+    events = _parse_answer_events(answer_events)
+    answer = answer_streams.start(session.id, agent_response_stream(req, session, events), "resume" in events)
+    return StreamingResponse(answer.read(), media_type="text/event-stream")
+
+
+# Allows clients which lost the connection while receiving an answer to get the events after the last one received
+# (whose id is "<answer_id>:<sequence number>") and keep receiving the answer, instead of asking again. Answers are only
+# available in the process generating them, when requested with "resume" in Answer-Events header, until
+# ANSWER_STREAMS_RESUME_SECONDS after the client disconnected, and for ANSWER_STREAMS_TTL_SECONDS after they end.
+@app.get('/sessions/{session_id}/answers/{answer_id}')
+async def resume_answer(session_id: str, answer_id: str, user: Annotated[str, Depends(get_current_user)],
+                        last_event_id: Annotated[Optional[str], Header()] = None) -> StreamingResponse:
+    session = await _find_session(session_id, user)
+    answer = answer_streams.get(answer_id)
+    if not answer or answer.session_id != session.id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'answer {answer_id} not found')
+    try:
+        last_seq = int(last_event_id.rpartition(":")[2]) if last_event_id else -1
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'invalid event id {last_event_id}') from None
+    if not answer.can_resume(last_seq):
+        raise HTTPException(status_code=status.HTTP_410_GONE,
+                            detail=f'answer {answer_id} events after {last_event_id} are no longer available')
+    metrics.resumed_streams.inc()
+    return StreamingResponse(answer.read(last_seq), media_type="text/event-stream")
 
 
 async def _find_session(session_id: str, user: str) -> Session:
-    ret = await sessions_repo.find_session(session_id)
+    with metrics.find_session_seconds.time():
+        ret = await sessions_repo.find_session(session_id)
     if not ret or ret.user != user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'session {session_id} not found')
     return ret
 
 
-async def agent_response_stream(req: QuestionRequest, session: Session) -> AsyncIterator[bytes]:
+# tokens generated within this time window or up to this size are sent in one event to reduce per event overhead
+SSE_COALESCE_WINDOW_SECONDS = float(os.getenv("SSE_COALESCE_WINDOW_SECONDS", "0.03"))
+SSE_COALESCE_MAX_CHARS = int(os.getenv("SSE_COALESCE_MAX_CHARS", "1024"))
+
+
+async def agent_response_stream(req: QuestionRequest, session: Session, events: Set[str]) \
+        -> AsyncIterator[ServerSentEvent]:
+    with metrics.open_streams.track(), metrics.stream_duration_seconds.time():
+        try:
+            async for event in _agent_response_stream(req, session, events):
+                yield event
+        except asyncio.CancelledError:
+            # the answer stream is cancelled when no client reads it, which cancels the agent answering the question
+            metrics.cancelled_streams.inc()
+            raise
+
+
+async def _agent_response_stream(req: QuestionRequest, session: Session, events: Set[str]) \
+        -> AsyncIterator[ServerSentEvent]:
+    start = time.perf_counter()
     try:
-        answer_stream = Agent(session).ask(req.question)
-        complete_answer = ""
+        answer_stream = coalesce_tokens(agent_pool.get(session).ask(req.question), SSE_COALESCE_WINDOW_SECONDS,
+                                        SSE_COALESCE_MAX_CHARS)
+        complete_answer = []
         async for token in answer_stream:
+            if isinstance(token, QueueStatus):
+                if "status" in events:
+                    yield ServerSentEvent(event="status", data=token.model_dump_json())
+                continue
+            if isinstance(token, ToolEvent):
+                if "tool" in events:
+                    yield ServerSentEvent(event="tool", data=token.model_dump_json())
+                continue
+            if not complete_answer:
+                metrics.time_to_first_token_seconds.observe(time.perf_counter() - start)
             if isinstance(token, str):
-                complete_answer = complete_answer + token
-                yield ServerSentEvent(data=token).encode()
+                complete_answer.append(token)
+                yield ServerSentEvent(data=token)
             else:
-                complete_answer = complete_answer + token.model_dump_json()
-                yield ServerSentEvent(event="flow", data=token.model_dump_json()).encode()
-        ret = Question(question=req.question, answer=complete_answer, session=session)
-        await questions_repo.save_question(ret)
+                flow = token.model_dump_json()
+                complete_answer.append(flow)
+                yield ServerSentEvent(event="flow", data=flow)
+        ret = Question(question=req.question, answer="".join(complete_answer), session=session)
+        await questions_writer.save(ret)
     except Exception as e:
         traceback.print_exception(e)
-        yield ServerSentEvent(event="error").encode()
+        yield ServerSentEvent(event="error")
+
+
+class InteractionResponse(BaseModel):
+    summary: Optional[str] = None
+
+
+# The extension sends interactions recorded with recordInteraction rules, and periodically polls for new summaries (with
+# no interaction) when pollInteractionPeriodSeconds is set in manifest. Requests with interactions which are batched
+# with previous ones, or equal to recently summarized ones, get no summary.
+@app.post('/sessions/{session_id}/interactions')
+async def process_interaction(session_id: str, user: Annotated[str, Depends(get_current_user)],
+                              detail: Annotated[Any, Body()] = None) -> InteractionResponse:
+    session = await _find_session(session_id, user)
+    return InteractionResponse(summary=await agent_pool.get(session).process_interaction(detail))
 
 
 class TranscriptionRequest(BaseModel):
@@ -104,7 +252,36 @@ class TranscriptionResponse(BaseModel):
 @app.post('/sessions/{session_id}/transcriptions')
 async def answer_transcription(session_id: str, req: TranscriptionRequest, user: Annotated[str, Depends(get_current_user)]) -> TranscriptionResponse:
     session = await _find_session(session_id, user)
-    ret = TranscriptionQuestion(base64=req.file, session=session)
-    audio_file_path = await transcriptions_repo.save_audio(ret)
-    text = Agent(session).transcript(audio_file_path)
+    return await _transcript(session, _single_chunk(base64.b64decode(req.file)))
+
+
+async def _single_chunk(data: bytes) -> AsyncIterator[bytes]:
+    yield data
+
+
+# Whisper API does not support files bigger than 25MB
+MAX_AUDIO_BYTES = 25 * 1024 * 1024
+
+
+# This endpoint allows sending the audio as binary request body, avoiding the overhead of base64 encoding it in a JSON
+@app.post('/sessions/{session_id}/transcriptions/audio')
+async def answer_audio_transcription(
+        session_id: str, request: Request, user: Annotated[str, Depends(get_current_user)]) -> TranscriptionResponse:
+    session = await _find_session(session_id, user)
+    return await _transcript(session, _limit_size(request.stream(), MAX_AUDIO_BYTES))
+
+
+async def _limit_size(chunks: AsyncIterator[bytes], max_bytes: int) -> AsyncIterator[bytes]:
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail=f'audio exceeds {max_bytes} bytes')
+        yield chunk
+
+
+async def _transcript(session: Session, chunks: AsyncIterator[bytes]) -> TranscriptionResponse:
+    audio = await transcriptions_repo.save_audio(TranscriptionQuestion(session=session), chunks)
+    text = await agent_pool.get(session).transcript(audio)
     return TranscriptionResponse(text=text)
@@ -1,15 +1,21 @@
+import asyncio
 import datetime
+import hashlib
+import logging
 import os
+import time
 import traceback
-from typing import Optional, Annotated, Any
+from collections import OrderedDict
+from typing import Optional, Annotated, Any, Tuple
 
-import requests
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OpenIdConnect
 from fastapi.security.utils import get_authorization_scheme_param
 from jose import JWTError, jwt
 from starlette.requests import Request
 
+from gpt_agent import http_clients, metrics
+
 
 def _build_auth_exception() -> HTTPException:
     return HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, headers={"WWW-Authenticate": "Bearer"})
@@ -27,41 +33,161 @@ class BearerOpenIdConnect(OpenIdConnect):
 
 class OpenIdConfig:
 
-    def __init__(self, url: str):
+    def __init__(self, url: str, refresh_period: datetime.timedelta, min_refresh_period: datetime.timedelta):
         self.url = url
-        self._last_update = None
+        self._refresh_period = refresh_period
+        self._min_refresh_period = min_refresh_period
+        self._jwks_uri = None
         self._keys = None
+        self._last_update = None
+        self._update_task: Optional[asyncio.Task] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._http_client = http_clients.build_client()
+
+    async def start(self) -> None:
+        try:
+            await self.get_keys()
+        except Exception as e:
+            logging.exception("Could not prefetch OpenID keys", exc_info=e)
+        self._refresh_task = asyncio.create_task(self._refresh_periodically())
+
+    async def stop(self) -> None:
+        if self._refresh_task:
+            self._refresh_task.cancel()
+
+    async def _refresh_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self._refresh_period.total_seconds())
+            try:
+                await self._update_keys_once()
+            except Exception as e:
+                logging.exception("Could not refresh OpenID keys", exc_info=e)
+
+    @property
+    def keys(self) -> Any:
+        return self._keys
+
+    async def get_keys(self) -> Any:
+        if self._keys is None or self._elapsed_since_update() > self._refresh_period:
+            await self._update_keys_once()
+        return self._keys
 
-    def get_updated_keys(self, period: datetime.timedelta) -> Any:
-        if self._last_update is None or datetime.datetime.utcnow() - self._last_update > period:
-            self._update_keys()
+    async def refresh_keys(self) -> Any:
+        # avoids hammering the identity provider when tokens signed with unknown keys are received
+        if self._elapsed_since_update() > self._min_refresh_period:
+            await self._update_keys_once()
         return self._keys
 
-    def _update_keys(self):
-        self.keys_last_update = datetime.datetime.utcnow()
-        config_resp = requests.get(self.url)
-        ret_resp = requests.get(config_resp.json()['jwks_uri'])
-        self._keys = ret_resp.json()
+    def _elapsed_since_update(self) -> datetime.timedelta:
+        return datetime.timedelta(seconds=time.monotonic() - self._last_update) if self._last_update is not None \
+            else datetime.timedelta.max
+
+    async def _update_keys_once(self) -> None:
+        # concurrent requests share the same in flight update
+        if self._update_task is None or self._update_task.done():
+            self._update_task = asyncio.create_task(self._update_keys())
+        await asyncio.shield(self._update_task)
+
+    async def _update_keys(self) -> None:
+        try:
+            if self._jwks_uri is None:
+                config_resp = await self._http_client.get(self.url)
+                config_resp.raise_for_status()
+                self._jwks_uri = config_resp.json()['jwks_uri']
+            keys_resp = await self._http_client.get(self._jwks_uri)
+            keys_resp.raise_for_status()
+            keys = keys_resp.json()
+            # only replace keys when they change, so key rotation can be detected by checking keys identity
+            if keys != self._keys:
+                self._keys = keys
+        except Exception as e:
+            self._jwks_uri = None
+            if self._keys is None:
+                raise
+            logging.exception("Could not update OpenID keys, using previous ones", exc_info=e)
+        finally:
+            self._last_update = time.monotonic()
+
+
+class VerifiedTokensCache:
+    # avoids verifying the signature of a token on each request, since the extension sends the same token in every
+    # request until it expires
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._entries: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        self._keys = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str, keys: Any) -> Optional[str]:
+        self._check_keys(keys)
+        key = self._hash(token)
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.time():
+            if entry:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def _check_keys(self, keys: Any) -> None:
+        if keys is not self._keys:
+            self._entries.clear()
+            self._keys = keys
+
+    @staticmethod
+    def _hash(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def put(self, token: str, username: str, expiration: Optional[float], keys: Any) -> None:
+        if expiration is None or self._max_size <= 0:
+            return
+        self._check_keys(keys)
+        self._entries[self._hash(token)] = (username, expiration)
+        if len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
 
 
 openid_url = os.getenv("OPENID_URL")
 if openid_url is not None:
     config_url = openid_url + "/.well-known/openid-configuration"
-    openid_config = OpenIdConfig(config_url)
+    openid_config = OpenIdConfig(config_url, refresh_period=datetime.timedelta(days=1),
+                                 min_refresh_period=datetime.timedelta(minutes=5))
     auth_scheme = BearerOpenIdConnect(openIdConnectUrl=config_url)
 else:
     openid_config = None
     auth_scheme = lambda: None
+tokens_cache = VerifiedTokensCache(int(os.getenv("AUTH_TOKENS_CACHE_SIZE", "10000")))
+metrics.CallbackCounter("gpt_agent_auth_tokens_cache_hits_total", "Requests authenticated with already verified tokens",
+                        lambda: tokens_cache.hits)
+metrics.CallbackCounter("gpt_agent_auth_tokens_cache_misses_total", "Requests with tokens that required verification",
+                        lambda: tokens_cache.misses)
+
+
+def _is_unknown_key(token: str, keys: Any) -> bool:
+    try:
+        kid = jwt.get_unverified_header(token).get("kid")
+    except JWTError:
+        return False
+    return kid is not None and all(key.get("kid") != kid for key in keys.get("keys", []))
 
 
-def _decode_token(token: str) -> dict:
-    openid_keys = openid_config.get_updated_keys(datetime.timedelta(days=1))
+async def _decode_token(token: str) -> dict:
+    openid_keys = await openid_config.get_keys()
     options = {"verify_aud": False}
     try:
         return jwt.decode(token, openid_keys, options=options)
     except JWTError as e:
-        new_keys = openid_config.get_updated_keys(datetime.timedelta(minutes=5))
-        if new_keys == openid_keys:
+        if not _is_unknown_key(token, openid_keys):
+            raise e
+        new_keys = await openid_config.refresh_keys()
+        if new_keys is openid_keys:
             raise e
         return jwt.decode(token, new_keys, options=options)
 
@@ -69,8 +195,12 @@ def _decode_token(token: str) -> dict:
 async def get_current_user(token: Annotated[Optional[str], Depends(auth_scheme)]) -> str:
     if openid_url is None:
         return ""
+    username = tokens_cache.get(token, openid_config.keys)
+    if username is not None:
+        return username
     try:
-        payload = _decode_token(token)
+        with metrics.auth_decode_seconds.time():
+            payload = await _decode_token(token)
         username = payload.get("email")
         # In Azure Authentication we haven't been able to get email attribute, but it is contained
         # in this attribute
@@ -78,6 +208,7 @@ async def get_current_user(token: Annotated[Optional[str], Depends(auth_scheme)]
             username = payload.get("unique_name")
         if username is None:
             raise _build_auth_exception()
+        tokens_cache.put(token, username, payload.get("exp"), openid_config.keys)
         return username
     except JWTError as e:
         traceback.print_exception(e)
@@ -0,0 +1,111 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple
+
+from gpt_agent import metrics
+from gpt_agent.cache import LruCache
+
+BATCH_WINDOW_SECONDS = float(os.getenv("INTERACTIONS_BATCH_WINDOW_SECONDS", "1"))
+BATCH_SIZE = int(os.getenv("INTERACTIONS_BATCH_SIZE", "10"))
+MAX_CHARS = int(os.getenv("INTERACTIONS_MAX_CHARS", "2000"))
+DEDUP_TTL_SECONDS = float(os.getenv("INTERACTIONS_DEDUP_TTL_SECONDS", "600"))
+# long strings in interactions (like encoded files or html contents) are truncated since they are costly to send to the
+# LLM and rarely help describing what the user did
+MAX_STRING_CHARS = 200
+
+
+def _compact(value: Any) -> Any:
+    if isinstance(value, str):
+        return value if len(value) <= MAX_STRING_CHARS else value[:MAX_STRING_CHARS] + "..."
+    elif isinstance(value, dict):
+        return {k: _compact(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [_compact(v) for v in value]
+    return value
+
+
+class _Batch:
+
+    def __init__(self):
+        self.interactions: List[str] = []
+        self.keys: List[str] = []
+        self.full = asyncio.Event()
+
+    def add(self, interaction: str, key: str) -> None:
+        # interactions of a failed batch may be retried by the extension
+        if key not in self.keys:
+            self.interactions.append(interaction)
+            self.keys.append(key)
+
+
+class InteractionsBatcher:
+    # Merges interactions of a session received within window_seconds (or up to batch_size of them) to summarize them
+    # with one LLM call, which gets the previous summary as context so only new interactions are described.
+    # Interactions equal to recently summarized ones are skipped without calling the LLM, since pages usually repeat
+    # the same requests (eg: polling or reloading a list).
+
+    def __init__(self, summarize: Callable[[List[str], Optional[str]], Awaitable[str]],
+                 window_seconds: float = BATCH_WINDOW_SECONDS, batch_size: int = BATCH_SIZE,
+                 max_chars: int = MAX_CHARS, dedup_ttl_seconds: float = DEDUP_TTL_SECONDS):
+        self._summarize = summarize
+        self._window_seconds = window_seconds
+        self._batch_size = batch_size
+        self._max_chars = max_chars
+        self._seen: LruCache[bool] = LruCache(1000, dedup_ttl_seconds)
+        self._batch: Optional[_Batch] = None
+        # interactions of batches which could not be summarized are added to the next batch, since only the request
+        # starting a batch gets the error and the extension only retries such request
+        self._failed: List[Tuple[str, str]] = []
+        self._summary: Optional[str] = None
+        self._lock = asyncio.Lock()
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def add(self, detail: Any) -> Optional[str]:
+        # only the request starting a batch gets its summary, so it is shown once to the user
+        if detail is None:
+            return None
+        interaction = json.dumps(_compact(detail), sort_keys=True, ensure_ascii=False,
+                                 separators=(",", ":"))[:self._max_chars]
+        key = hashlib.sha256(interaction.encode()).hexdigest()
+        if self._seen.get(key):
+            metrics.skipped_interactions.inc()
+            return None
+        self._seen.put(key, True)
+        batch = self._batch
+        task = None
+        if not batch:
+            batch = self._batch = _Batch()
+            for failed_interaction, failed_key in self._failed:
+                self._seen.put(failed_key, True)
+                batch.add(failed_interaction, failed_key)
+            self._failed = []
+            # processed in a separate task so the batch is not lost when the request starting it is cancelled
+            task = asyncio.create_task(self._process(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        batch.add(interaction, key)
+        if len(batch.interactions) >= self._batch_size:
+            batch.full.set()
+        return await asyncio.shield(task) if task else None
+
+    async def _process(self, batch: _Batch) -> str:
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(batch.full.wait(), self._window_seconds)
+        if self._batch is batch:
+            self._batch = None
+        # batches are summarized in order, so each one gets the summary of the previous one
+        async with self._lock:
+            try:
+                self._summary = await self._summarize(batch.interactions, self._summary)
+            except Exception:
+                # allows summarizing the interactions when the extension retries them
+                for key in batch.keys:
+                    self._seen.pop(key)
+                # only the latest ones are kept, so failures don't make batches grow without limit
+                self._failed = (self._failed + list(zip(batch.interactions, batch.keys)))[-self._batch_size:]
+                raise
+            metrics.summarized_interactions.inc(len(batch.interactions))
+            return self._summary
@@ -0,0 +1,75 @@
+import asyncio
+import contextlib
+import os
+import uuid
+import weakref
+from abc import ABC, abstractmethod
+from typing import AsyncIterator
+
+from gpt_agent.file_system_repos import get_session_path
+
+LOCK_FILE = "session.lock"
+
+
+class SessionLocks(ABC):
+    # serializes questions on a session, so concurrent questions don't interleave messages in chat history
+
+    @abstractmethod
+    def lock(self, session_id: uuid.UUID) -> contextlib.AbstractAsyncContextManager[None]:
+        pass
+
+
+class LocalSessionLocks(SessionLocks):
+    # only serializes questions handled by this process
+
+    def __init__(self):
+        self._locks: weakref.WeakValueDictionary[uuid.UUID, asyncio.Lock] = weakref.WeakValueDictionary()
+
+    @contextlib.asynccontextmanager
+    async def lock(self, session_id: uuid.UUID) -> AsyncIterator[None]:
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[session_id] = lock
+        async with lock:
+            yield
+
+
+class FileSessionLocks(LocalSessionLocks):
+    # serializes questions handled by any process (workers or replicas) sharing the sessions folder, using a lock file
+    # in the session folder. Questions in the same process wait on the local lock, so only one of them polls the file.
+
+    def __init__(self, poll_seconds: float):
+        super().__init__()
+        self._poll_seconds = poll_seconds
+
+    @contextlib.asynccontextmanager
+    async def lock(self, session_id: uuid.UUID) -> AsyncIterator[None]:
+        # imported on demand since fcntl is not available in all platforms
+        import fcntl
+        async with super().lock(session_id):
+            session_path = get_session_path(session_id)
+            os.makedirs(session_path, exist_ok=True)
+            with open(os.path.join(session_path, LOCK_FILE), "w", encoding="utf-8") as f:
+                while True:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        await asyncio.sleep(self._poll_seconds)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def build_session_locks() -> SessionLocks:
+    backend = os.getenv("SESSION_LOCKS", "local")
+    if backend == "local":
+        return LocalSessionLocks()
+    elif backend == "file":
+        return FileSessionLocks(float(os.getenv("SESSION_LOCKS_POLL_SECONDS", "0.05")))
+    raise ValueError(f"Unsupported session locks: {backend}")
+
+
+session_locks = build_session_locks()
@@ -0,0 +1,174 @@
+import bisect
+import contextlib
+import time
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+# Minimal implementation of Prometheus metrics, exposed in text format, which avoids adding a dependency and keeps
+# recording cheap enough (a few dict and list operations) to leave it always enabled.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self._label_names = tuple(label_names)
+        registry.append(self)
+
+    def collect(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} {self.type}"
+        yield from self._samples()
+
+    def _samples(self) -> Iterator[str]:
+        raise NotImplementedError()
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        super().__init__(name, description, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {} if label_names else {(): 0}
+
+    def inc(self, value: float = 1, *labels: str) -> None:
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def _samples(self) -> Iterator[str]:
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self._label_names, labels)} {value}"
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, value: float = 1, *labels: str) -> None:
+        self.inc(-value, *labels)
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+    @contextlib.contextmanager
+    def track(self, *labels: str) -> Iterator[None]:
+        self.inc(1, *labels)
+        try:
+            yield
+        finally:
+            self.dec(1, *labels)
+
+
+class CallbackGauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, description: str, callback: Callable[[], float]):
+        super().__init__(name, description)
+        self._callback = callback
+
+    def _samples(self) -> Iterator[str]:
+        yield f"{self.name} {self._callback()}"
+
+
+class CallbackCounter(CallbackGauge):
+    type = "counter"
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description, label_names)
+        self._buckets = tuple(buckets)
+        # per labels: counts per bucket (last one is +Inf) and sum of observed values
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = ([0] * (len(self._buckets) + 1), [0.0])
+            self._values[labels] = entry
+        entry[0][bisect.bisect_left(self._buckets, value)] += 1
+        entry[1][0] += value
+
+    @contextlib.contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def _samples(self) -> Iterator[str]:
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{float(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self._label_names, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self._label_names, labels)} {total[0]}"
+            yield f"{self.name}_count{_format_labels(self._label_names, labels)} {cumulative}"
+
+
+registry: List[_Metric] = []
+
+
+def render() -> str:
+    return "\n".join(line for metric in registry for line in metric.collect()) + "\n"
+
+
+auth_decode_seconds = Histogram("gpt_agent_auth_decode_seconds", "Time verifying authentication tokens")
+find_session_seconds = Histogram("gpt_agent_find_session_seconds", "Time finding sessions")
+agent_construction_seconds = Histogram("gpt_agent_agent_construction_seconds", "Time building session agents")
+time_to_first_token_seconds = Histogram("gpt_agent_time_to_first_token_seconds",
+                                        "Time from question received to first answer token")
+stream_duration_seconds = Histogram("gpt_agent_stream_duration_seconds", "Duration of answer streams")
+answer_tokens = Histogram("gpt_agent_answer_tokens", "Number of tokens generated per answer", buckets=COUNT_BUCKETS)
+open_streams = Gauge("gpt_agent_open_streams", "Number of answer streams in progress")
+cancelled_streams = Counter("gpt_agent_cancelled_streams_total",
+                            "Number of answers cancelled for not being read by any client")
+tool_seconds = Histogram("gpt_agent_tool_seconds", "Time executing tools", label_names=("tool",))
+tool_errors = Counter("gpt_agent_tool_errors_total", "Number of tool calls which failed or timed out",
+                      label_names=("tool",))
+persistence_seconds = Histogram("gpt_agent_persistence_seconds", "Time persisting batches of questions")
+transcription_seconds = Histogram("gpt_agent_transcription_seconds", "Time transcribing audios")
+answer_cache_hits = Counter("gpt_agent_answer_cache_hits_total", "Questions answered from answers cache")
+queued_llm_calls = Gauge("gpt_agent_queued_llm_calls", "Number of questions waiting to be sent to the LLM")
+llm_rate_limited = Counter("gpt_agent_llm_rate_limited_total", "Number of LLM responses with 429 status code")
+answer_cache_misses = Counter("gpt_agent_answer_cache_misses_total", "Cacheable questions not found in answers cache")
+summarized_interactions = Counter("gpt_agent_summarized_interactions_total",
+                                  "Number of interactions recorded by the extension summarized with the LLM")
+skipped_interactions = Counter("gpt_agent_skipped_interactions_total",
+                               "Number of interactions skipped for being equal to recently summarized ones")
+interactions_summary_seconds = Histogram("gpt_agent_interactions_summary_seconds",
+                                         "Time summarizing batches of interactions")
+resumed_streams = Counter("gpt_agent_resumed_streams_total", "Number of answer streams resumed by clients")
+lost_stream_events = Counter("gpt_agent_lost_stream_events_total",
+                            "Number of answer stream readers ended for falling behind discarded events")
+retention_deleted_files = Counter("gpt_agent_retention_deleted_files_total",
+                                  "Number of session files deleted for exceeding their retention time")
+retention_deleted_rows = Counter("gpt_agent_retention_deleted_rows_total",
+                                 "Number of questions and audios deleted from database for exceeding retention time")
+retention_freed_bytes = Counter("gpt_agent_retention_freed_bytes_total",
+                                "Bytes freed by deleting expired session files and compacting question files")
+warm_up_seconds = Gauge("gpt_agent_warm_up_seconds", "Time warming up the server after startup")
+http_requests = Counter("gpt_agent_http_requests_total", "Number of requests sent to upstream services",
+                        label_names=("upstream",))
+http_connections = Counter("gpt_agent_http_connections_total", "Number of connections opened to upstream services",
+                           label_names=("upstream",))
+http_connect_seconds = Histogram("gpt_agent_http_connect_seconds",
+                                 "Time opening connections (including TLS handshake) to upstream services",
+                                 label_names=("upstream",))
+http_response_seconds = Histogram("gpt_agent_http_response_seconds",
+                                  "Time from request start to response headers received from upstream services",
+                                  label_names=("upstream",))
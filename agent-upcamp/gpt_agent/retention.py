@@ -0,0 +1,234 @@
+import asyncio
+import contextlib
+import datetime
+import gzip
+import logging
+import os
+import shutil
+import time
+import uuid
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from gpt_agent import metrics
+from gpt_agent.file_system_repos import QUESTIONS_ARCHIVE, SESSIONS_PATH
+from gpt_agent.locks import LOCK_FILE, session_locks
+from gpt_agent.repos import SessionsRepository, QuestionsRepository, TranscriptionsRepository
+
+SWEEP_LOCK_FILE = "retention.lock"
+
+
+class _File(NamedTuple):
+    path: str
+    size: int
+    mtime: float
+
+
+def _list_files(path: str) -> List[_File]:
+    ret = []
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            # lock file is modified when locking the session, including when sweeping it
+            if file_name == LOCK_FILE:
+                continue
+            file_path = os.path.join(dir_path, file_name)
+            with contextlib.suppress(FileNotFoundError):
+                stat = os.stat(file_path)
+                ret.append(_File(file_path, stat.st_size, stat.st_mtime))
+    return ret
+
+
+def _is_audio(file: _File) -> bool:
+    return os.path.basename(os.path.dirname(file.path)) == "audio"
+
+
+def _is_question(file: _File) -> bool:
+    name = os.path.basename(file.path)
+    return name.startswith("question-") and name.endswith(".json") or name == QUESTIONS_ARCHIVE
+
+
+def _remove(path: str) -> None:
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+
+def _remove_all(files: List[_File]) -> None:
+    for file in files:
+        _remove(file.path)
+
+
+def _compact_questions(archive_path: str, files: List[_File]) -> int:
+    # the archive is written to a temporary file, which replaces the archive once complete, so a failed compaction
+    # doesn't corrupt the archive, and question files are only removed once they are in the archive
+    tmp_path = archive_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as tmp:
+            if os.path.exists(archive_path):
+                with open(archive_path, "rb") as archive:
+                    shutil.copyfileobj(archive, tmp)
+            archive_size = tmp.tell()
+            # question files are appended as lines of a gzip member, which gzip readers concatenate with previous ones
+            with gzip.GzipFile(fileobj=tmp, mode="wb", mtime=0) as member:
+                for file in files:
+                    with open(file.path, "rb") as f:
+                        member.write(f.read().strip() + b"\n")
+            compacted_size = tmp.tell() - archive_size
+        os.replace(tmp_path, archive_path)
+    except BaseException:
+        _remove(tmp_path)
+        raise
+    _remove_all(files)
+    # gzip member overhead may exceed the size of a few small files
+    return max(sum(file.size for file in files) - compacted_size, 0)
+
+
+@contextlib.contextmanager
+def _exclusive_sweep() -> Iterator[bool]:
+    # every worker (and replicas sharing sessions folder) runs a sweeper, but only one of them sweeps at a time
+    try:
+        # imported on demand since fcntl is not available in all platforms, where only one process uses the folder
+        import fcntl
+    except ImportError:
+        yield True
+        return
+    with open(os.path.join(SESSIONS_PATH, SWEEP_LOCK_FILE), "w", encoding="utf-8") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class RetentionSweeper:
+    # Periodically deletes audios, questions and whole sessions (including chat history) older than their retention
+    # time (0 keeps them forever), and compacts question files of sessions idle for compact_idle_seconds (0 disables
+    # it) into one archive, so disk usage and the number of files in sessions folder don't grow forever. File
+    # operations are run in a thread, while holding the session lock, and limited to max_files_per_second, so sweeps
+    # don't compete with requests for disk I/O. Sessions, questions and audios stored in other storage backends (like
+    # sqlite) are deleted through repositories, considering sessions idle when their folder (with chat history) is.
+
+    def __init__(self, audio_seconds: float, questions_seconds: float, sessions_seconds: float,
+                 compact_idle_seconds: float, interval_seconds: float, max_files_per_second: float,
+                 sessions_repo: SessionsRepository, questions_repo: QuestionsRepository,
+                 transcriptions_repo: TranscriptionsRepository):
+        self._audio_seconds = audio_seconds
+        self._questions_seconds = questions_seconds
+        self._sessions_seconds = sessions_seconds
+        self._compact_idle_seconds = compact_idle_seconds
+        self._interval_seconds = interval_seconds
+        self._max_files_per_second = max_files_per_second
+        self._sessions_repo = sessions_repo
+        self._questions_repo = questions_repo
+        self._transcriptions_repo = transcriptions_repo
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if any([self._audio_seconds, self._questions_seconds, self._sessions_seconds, self._compact_idle_seconds]):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                start = time.perf_counter()
+                freed = await self.sweep()
+                logging.info("Retention sweep freed %d bytes in %.1f seconds", freed, time.perf_counter() - start)
+            except Exception as e:
+                logging.exception("Error sweeping sessions", exc_info=e)
+            await asyncio.sleep(self._interval_seconds)
+
+    async def sweep(self) -> int:
+        if not os.path.isdir(SESSIONS_PATH):
+            return 0
+        with _exclusive_sweep() as acquired:
+            if not acquired:
+                logging.info("Skipping retention sweep since another process is sweeping sessions")
+                return 0
+            await self._delete_expired_rows()
+            session_paths = await asyncio.to_thread(lambda: [e.path for e in os.scandir(SESSIONS_PATH) if e.is_dir()])
+            ret = 0
+            for session_path in session_paths:
+                try:
+                    freed, files_count = await self._sweep_session(session_path)
+                except Exception as e:
+                    logging.exception("Error sweeping session %s", session_path, exc_info=e)
+                    continue
+                ret += freed
+                # throttled after releasing the session lock, so questions on the session don't wait for it
+                await self._throttle(files_count)
+            return ret
+
+    async def _sweep_session(self, session_path: str) -> Tuple[int, int]:
+        try:
+            session_id = uuid.UUID(os.path.basename(session_path))
+        except ValueError:
+            return 0, 0
+        async with session_locks.lock(session_id):
+            files = await asyncio.to_thread(_list_files, session_path)
+            now = time.time()
+            idle_seconds = now - max((file.mtime for file in files), default=now)
+            if self._sessions_seconds and idle_seconds > self._sessions_seconds:
+                await asyncio.to_thread(shutil.rmtree, session_path, True)
+                await self._sessions_repo.delete_session(session_id)
+                return self._record(files), len(files)
+            expired = [file for file in files if self._is_expired(file, now)]
+            await asyncio.to_thread(_remove_all, expired)
+            ret = self._record(expired)
+            questions = sorted([file for file in files if _is_question(file) and file not in expired
+                                and os.path.basename(file.path) != QUESTIONS_ARCHIVE], key=lambda f: (f.mtime, f.path))
+            if not (self._compact_idle_seconds and idle_seconds > self._compact_idle_seconds and questions):
+                return ret, len(expired)
+            freed = await asyncio.to_thread(_compact_questions, os.path.join(session_path, QUESTIONS_ARCHIVE),
+                                            questions)
+            metrics.retention_freed_bytes.inc(freed)
+            return ret + freed, len(expired) + len(questions)
+
+    async def _delete_expired_rows(self) -> None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        deleted = 0
+        if self._questions_seconds:
+            deleted += await self._questions_repo.delete_questions(
+                now - datetime.timedelta(seconds=self._questions_seconds))
+        if self._audio_seconds:
+            deleted += await self._transcriptions_repo.delete_audios(
+                now - datetime.timedelta(seconds=self._audio_seconds))
+        metrics.retention_deleted_rows.inc(deleted)
+
+    def _is_expired(self, file: _File, now: float) -> bool:
+        if _is_audio(file):
+            return bool(self._audio_seconds) and now - file.mtime > self._audio_seconds
+        if _is_question(file):
+            return bool(self._questions_seconds) and now - file.mtime > self._questions_seconds
+        return False
+
+    @staticmethod
+    def _record(files: List[_File]) -> int:
+        ret = sum(file.size for file in files)
+        metrics.retention_deleted_files.inc(len(files))
+        metrics.retention_freed_bytes.inc(ret)
+        return ret
+
+    async def _throttle(self, files_count: int) -> None:
+        await asyncio.sleep(files_count / self._max_files_per_second)
+
+
+def build_retention_sweeper(sessions_repo: SessionsRepository, questions_repo: QuestionsRepository,
+                            transcriptions_repo: TranscriptionsRepository) -> RetentionSweeper:
+    return RetentionSweeper(audio_seconds=float(os.getenv("RETENTION_AUDIO_SECONDS", "0")),
+                            questions_seconds=float(os.getenv("RETENTION_QUESTIONS_SECONDS", "0")),
+                            sessions_seconds=float(os.getenv("RETENTION_SESSIONS_SECONDS", "0")),
+                            compact_idle_seconds=float(os.getenv("RETENTION_COMPACT_IDLE_SECONDS", "0")),
+                            interval_seconds=float(os.getenv("RETENTION_SWEEP_INTERVAL_SECONDS", "3600")),
+                            max_files_per_second=float(os.getenv("RETENTION_MAX_FILES_PER_SECOND", "100")),
+                            sessions_repo=sessions_repo, questions_repo=questions_repo,
+                            transcriptions_repo=transcriptions_repo)
@@ -0,0 +1,189 @@
+import asyncio
+import datetime
+import glob
+import gzip
+import json
+import os
+import sqlite3
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Iterable, List
+
+import dotenv
+
+from gpt_agent import repos
+from gpt_agent.file_system_repos import QUESTIONS_ARCHIVE
+from gpt_agent.domain import Session, Question, TranscriptionQuestion
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    user TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_user ON sessions (user);
+CREATE TABLE IF NOT EXISTS questions (
+    id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    question TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS questions_session_id ON questions (session_id);
+CREATE TABLE IF NOT EXISTS audios (
+    id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    data BLOB NOT NULL,
+    created_at TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS audios_session_id ON audios (session_id);
+"""
+
+
+class SqliteDatabase:
+    # all operations run in a dedicated thread, which serializes access to the connection and avoids blocking the
+    # event loop
+
+    def __init__(self, path: str):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = self._executor.submit(self._connect, path).result()
+
+    @staticmethod
+    def _connect(path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        return conn
+
+    async def fetch_one(self, sql: str, params: Iterable[Any] = ()) -> Any:
+        return await self._run(lambda: self._conn.execute(sql, params).fetchone())
+
+    async def execute(self, sql: str, params: Iterable[Any] = ()) -> int:
+        return await self.execute_many(sql, [params])
+
+    async def execute_many(self, sql: str, rows: List[Iterable[Any]]) -> int:
+        return await self._run(lambda: self.execute_many_sync(sql, rows))
+
+    def execute_many_sync(self, sql: str, rows: List[Iterable[Any]]) -> int:
+        # returns the number of modified rows
+        with self._conn:
+            return self._conn.executemany(sql, rows).rowcount
+
+    async def _run(self, fn) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn)
+
+    def close(self) -> None:
+        self._executor.submit(self._conn.close).result()
+        self._executor.shutdown()
+
+
+def _now() -> str:
+    return _format_time(datetime.datetime.now(datetime.timezone.utc))
+
+
+def _format_time(value: datetime.datetime) -> str:
+    # times are stored as UTC ISO strings, so they can be compared as strings
+    return value.astimezone(datetime.timezone.utc).isoformat()
+
+
+class SessionsRepository(repos.SessionsRepository):
+
+    def __init__(self, db: SqliteDatabase):
+        super().__init__()
+        self._db = db
+
+    async def _write_session(self, session: Session) -> None:
+        await self._db.execute("INSERT OR REPLACE INTO sessions (id, user, data, created_at) VALUES (?, ?, ?, ?)",
+                               (str(session.id), session.user, session.model_dump_json(), _now()))
+
+    async def _read_session(self, session_id: uuid.UUID) -> Session | None:
+        row = await self._db.fetch_one("SELECT data FROM sessions WHERE id = ?", (str(session_id),))
+        return Session(**json.loads(row[0])) if row else None
+
+    async def _delete_session(self, session_id: uuid.UUID) -> None:
+        for table, column in (("questions", "session_id"), ("audios", "session_id"), ("sessions", "id")):
+            await self._db.execute(f"DELETE FROM {table} WHERE {column} = ?", (str(session_id),))
+
+
+class QuestionsRepository(repos.QuestionsRepository):
+
+    def __init__(self, db: SqliteDatabase):
+        self._db = db
+
+    async def save_questions(self, questions: List[Question]) -> None:
+        await self._db.execute_many(
+            "INSERT INTO questions (id, session_id, question, answer, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(str(q.id), str(q.session.id), q.question, q.answer, _now()) for q in questions])
+
+    async def delete_questions(self, before: datetime.datetime) -> int:
+        return await self._db.execute("DELETE FROM questions WHERE created_at < ?", (_format_time(before),))
+
+
+class TranscriptionsRepository(repos.TranscriptionsRepository):
+
+    def __init__(self, db: SqliteDatabase):
+        self._db = db
+
+    async def save_audio(self, question: TranscriptionQuestion, chunks: AsyncIterator[bytes]) -> bytes:
+        ret = b"".join([chunk async for chunk in chunks])
+        await self._db.execute("INSERT INTO audios (id, session_id, data, created_at) VALUES (?, ?, ?, ?)",
+                               (str(question.id), str(question.session.id), ret, _now()))
+        return ret
+
+    async def delete_audios(self, before: datetime.datetime) -> int:
+        return await self._db.execute("DELETE FROM audios WHERE created_at < ?", (_format_time(before),))
+
+
+def _file_time(path: str) -> str:
+    return datetime.datetime.fromtimestamp(os.path.getmtime(path), datetime.timezone.utc).isoformat()
+
+
+def import_sessions(db: SqliteDatabase, sessions_path: str) -> int:
+    # imports sessions stored by file system repositories
+    ret = 0
+    for session_file in glob.glob(os.path.join(sessions_path, "*", "session.json")):
+        session_path = os.path.dirname(session_file)
+        with open(session_file, encoding="utf-8") as f:
+            session = Session(**json.load(f))
+        db.execute_many_sync("INSERT OR REPLACE INTO sessions (id, user, data, created_at) VALUES (?, ?, ?, ?)",
+                             [(str(session.id), session.user, session.model_dump_json(), _file_time(session_file))])
+        questions = []
+        for question_file in glob.glob(os.path.join(session_path, "question-*.json")):
+            with open(question_file, encoding="utf-8") as f:
+                question = json.load(f)
+            questions.append((question["id"], str(session.id), question["question"], question["answer"],
+                              _file_time(question_file)))
+        # questions compacted by retention sweeper only keep the time of the archive
+        archive_file = os.path.join(session_path, QUESTIONS_ARCHIVE)
+        if os.path.exists(archive_file):
+            with gzip.open(archive_file, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        question = json.loads(line)
+                        questions.append((question["id"], str(session.id), question["question"], question["answer"],
+                                          _file_time(archive_file)))
+        db.execute_many_sync(
+            "INSERT OR REPLACE INTO questions (id, session_id, question, answer, created_at) VALUES (?, ?, ?, ?, ?)",
+            questions)
+        audios = []
+        for audio_file in glob.glob(os.path.join(session_path, "audio", "*.webm")):
+            with open(audio_file, 'rb') as f:
+                audios.append((str(uuid.uuid5(uuid.NAMESPACE_URL, audio_file)), str(session.id), f.read(),
+                               _file_time(audio_file)))
+        db.execute_many_sync("INSERT OR REPLACE INTO audios (id, session_id, data, created_at) VALUES (?, ?, ?, ?)",
+                             audios)
+        ret += 1
+    return ret
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    sqlite_db = SqliteDatabase(os.getenv("SQLITE_DB_PATH", "sessions.db"))
+    try:
+        count = import_sessions(sqlite_db, sys.argv[1] if len(sys.argv) > 1 else "sessions")
+        print(f"Imported {count} sessions")
+    finally:
+        sqlite_db.close()
@@ -0,0 +1,54 @@
+import asyncio
+import functools
+import json
+import os
+from typing import Awaitable, Callable, Optional
+
+from langchain_core.tools import StructuredTool, ToolException
+
+from gpt_agent.cache import LruCache
+
+DEFAULT_TIMEOUT_SECONDS = float(os.getenv("TOOLS_TIMEOUT_SECONDS", "30"))
+# tool errors are reported to the agent as tool outputs (through on_tool_end callbacks), so they are tagged with this
+# prefix to tell them apart from successful outputs
+TOOL_ERROR_PREFIX = "Tool error: "
+
+
+def is_tool_error(output: str) -> bool:
+    return output.startswith(TOOL_ERROR_PREFIX)
+
+
+def _handle_tool_error(e: ToolException) -> str:
+    return f"{TOOL_ERROR_PREFIX}{e}"
+
+
+def async_tool(timeout_seconds: float = DEFAULT_TIMEOUT_SECONDS, cache_ttl_seconds: Optional[float] = None,
+               cache_size: int = 1000, return_direct: bool = False) \
+        -> Callable[[Callable[..., Awaitable[str]]], StructuredTool]:
+    # Builds a tool from an async function, which runs in the event loop instead of the default threadpool used for
+    # sync tools. Calls taking longer than timeout_seconds are reported to the agent as errors instead of blocking the
+    # answer, and when cache_ttl_seconds is set results are reused for calls with same arguments.
+    # When AGENT_PARALLEL_TOOLS=true, tool calls requested by the LLM in the same step are run concurrently by the agent
+    # executor, otherwise the LLM requests one tool call per step.
+
+    def decorator(fn: Callable[..., Awaitable[str]]) -> StructuredTool:
+        cache: Optional[LruCache[str]] = LruCache(cache_size, cache_ttl_seconds) if cache_ttl_seconds else None
+
+        @functools.wraps(fn)
+        async def run(**kwargs) -> str:
+            key = json.dumps(kwargs, sort_keys=True, default=str)
+            ret = cache.get(key) if cache is not None else None
+            if ret is not None:
+                return ret
+            try:
+                ret = await asyncio.wait_for(fn(**kwargs), timeout_seconds)
+            except asyncio.TimeoutError:
+                raise ToolException(f"{fn.__name__} did not respond in {timeout_seconds} seconds") from None
+            if cache is not None:
+                cache.put(key, ret)
+            return ret
+
+        return StructuredTool.from_function(coroutine=run, name=fn.__name__, description=fn.__doc__,
+                                            return_direct=return_direct, handle_tool_error=_handle_tool_error)
+
+    return decorator
@@ -74,7 +74,12 @@ export class Agent {
     }
 
     public async * ask(msg: string, sessionId: string, authService?: AuthService): AsyncIterable<string | AgentFlow> {
-        const ret = await fetchStreamJson(`${this.sessionUrl(sessionId)}/questions`, await this.buildHttpPost({ question: msg }, authService))
+        const options = await this.buildHttpPost({ question: msg }, authService)
+        // the agent only sends events not supported by previous extension versions when they are listed in this header
+        const headers = options.headers as Record<string, string>
+        headers['Answer-Events'] = "status, tool, resume"
+        const ret = await fetchStreamJson(`${this.sessionUrl(sessionId)}/questions`, options,
+            lastEventId => `${this.sessionUrl(sessionId)}/answers/${lastEventId.split(":")[0]}`)
         for await (const part of ret) {
             if (typeof part === "string") {
                 yield part
@@ -55,11 +55,11 @@ export class NetworkError extends BaseError {
   readonly type: string = 'NetworkError'
 }
 
-export async function* fetchStreamJson(url: string, options?: RequestInit): AsyncIterable<any> {
+export async function* fetchStreamJson(url: string, options?: RequestInit, resumeUrl?: (lastEventId: string) => string): AsyncIterable<any> {
   let resp = await fetchResponse(url, options)
   let contentType = resp.headers.get("content-type")
   if (contentType?.startsWith("text/event-stream")) {
-    let ret = await fetchSSEStream(resp, url, options)
+    let ret = await fetchSSEStream(resp, url, options, resumeUrl)
     for await (const part of ret) {
       yield part
     }
@@ -68,18 +68,40 @@ export async function* fetchStreamJson(url: string, options?: RequestInit): Asyn
   }
 }
 
-async function* fetchSSEStream(resp: Response, url: string, options?: RequestInit): AsyncIterable<any> {
+async function* fetchSSEStream(resp: Response, url: string, options?: RequestInit, resumeUrl?: (lastEventId: string) => string, maxResumes = 3): AsyncIterable<any> {
   let reader = resp.body!.getReader()
   let done = false
+  let lastEventId: string | undefined
+  let resumes = 0
   while (!done) {
-    let result = await reader.read()
+    let result
+    try {
+      result = await reader.read()
+    } catch (e) {
+      // when the connection is lost (eg: dropped by a proxy) the stream is resumed after the last received event, instead of asking again
+      if (!resumeUrl || !lastEventId || resumes >= maxResumes) {
+        throw e
+      }
+      resumes++
+      const headers = { ...options?.headers as Record<string, string>, "Last-Event-ID": lastEventId }
+      reader = (await fetchResponse(resumeUrl(lastEventId), { method: "GET", headers: headers })).body!.getReader()
+      continue
+    }
     done = result.done
     let events = ServerSentEvent.fromBytes(result.value!)
     for (const event of events) {
+      if (event.id) {
+        lastEventId = event.id
+      }
       if (event.event === "error") {
         console.warn(`Problem while reading stream response from ${options?.method ? options.method : 'GET'} ${url}`, event)
         throw new HttpServiceError()
       }
+      // status events (like position in queue while waiting for the agent to answer) and tool events (tools started
+      // or finished by the agent while answering) are not part of the response
+      if (event.event === "status" || event.event === "tool") {
+        continue
+      }
       if (event.event) {
         yield JSON.parse(event.data)
       } else {
@@ -90,12 +112,14 @@ async function* fetchSSEStream(resp: Response, url: string, options?: RequestIni
 }
 
 class ServerSentEvent {
+  id?: string
   event?: string
   data: string
 
-  constructor(data: string, event?: string) {
+  constructor(data: string, event?: string, id?: string) {
     this.data = data
     this.event = event
+    this.id = id
   }
 
   public static fromBytes(bs: Uint8Array): ServerSentEvent[] {
@@ -106,13 +130,12 @@ class ServerSentEvent {
 
   private static parseEvent(event: string): ServerSentEvent {
     let parts = event.split(/\r\n/)
-    let eventType
+    let idPrefix = "id: "
+    let id = parts.find(p => p.startsWith(idPrefix))?.substring(idPrefix.length)
     let eventPrefix = "event: "
-    if (parts[0].startsWith(eventPrefix)) {
-      eventType = parts[0].substring(eventPrefix.length)
-    }
+    let eventType = parts.find(p => p.startsWith(eventPrefix))?.substring(eventPrefix.length)
     let dataPrefix = "data: "
     let data = parts.filter(p => p.startsWith(dataPrefix)).map(p => p.substring(dataPrefix.length)).join("\n")
-    return new ServerSentEvent(data, eventType)
+    return new ServerSentEvent(data, eventType, id)
   }
 }